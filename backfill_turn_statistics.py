@@ -0,0 +1,17 @@
+import asyncio
+
+from civ_vi_webhook.models.db import mongo_setup
+from civ_vi_webhook.services.db import game_service
+
+
+async def backfill_statistics():
+    await game_service.backfill_turn_statistics()
+
+
+async def main():
+    await mongo_setup.init_db_from_credentials()
+    await backfill_statistics()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
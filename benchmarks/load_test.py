@@ -0,0 +1,367 @@
+"""Replay a mix of webhook, API and homepage traffic against the server and report latency per route.
+
+The server is started in its own process against an in-memory Mongo stand-in (mongomock-motor) or a local
+mongod (--mongo-url), and sends its Matrix messages to a stub homeserver run by this script.
+
+    python benchmarks/load_test.py --concurrency 20 --requests 2000 --output results.json
+    python benchmarks/load_test.py --compare results.json --output new_results.json
+
+Run from the root of the repository with the dev dependencies installed.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import platform
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Optional
+
+import aiohttp
+from aiohttp import web
+
+REPO_ROOT = Path(__file__).resolve().parents[1]
+if str(REPO_ROOT) not in sys.path:
+    sys.path.insert(0, str(REPO_ROOT))
+
+DEFAULT_MIX = "webhook=25,pydt=10,current_games=15,blame=10,blame_summary=5,total_number_of_games=5," \
+              "completed_games=5,homepage=10,current_games_table=15"
+
+
+# ##########
+# Stub Matrix homeserver
+# ##########
+
+class StubHomeserver:
+    """Just enough of the Matrix client-server API for the notification dispatcher to log in and send."""
+
+    def __init__(self, send_delay: float = 0.0):
+        self.send_delay = send_delay
+        self.messages_received = 0
+        self._runner: Optional[web.AppRunner] = None
+
+    async def login(self, request: web.Request) -> web.Response:
+        return web.json_response({"user_id": "@civ_bot:stub", "access_token": "stub-token", "device_id": "STUB"})
+
+    async def room_send(self, request: web.Request) -> web.Response:
+        if self.send_delay:
+            await asyncio.sleep(self.send_delay)
+        self.messages_received += 1
+        return web.json_response({"event_id": f"$stub{self.messages_received}"})
+
+    async def start(self, port: int):
+        app = web.Application()
+        app.router.add_post("/_matrix/client/{version}/login", self.login)
+        app.router.add_put("/_matrix/client/{version}/rooms/{room_id}/send/{event_type}/{txn_id}", self.room_send)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, "127.0.0.1", port).start()
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+
+# ##########
+# Server process
+# ##########
+
+def player_names(players: int) -> list[str]:
+    return [f"player{number}" for number in range(players)]
+
+
+async def seed_data(players: int, games: int, completed_games: int):
+    """Users with Matrix and index names, and games with a few weeks of turns behind them."""
+    from civ_vi_webhook.services.db import game_service, user_service
+
+    random.seed(0)
+    users = [await user_service.create_user(name, matrix_username=f"@{name}:stub", index_name=name.title())
+             for name in player_names(players)]
+    start = datetime.now() - timedelta(days=30)
+    for number in range(games + completed_games):
+        game_name = f"Seed Game {number}"
+        for turn in range(1, random.randint(2, 6)):
+            await game_service.record_turn(game_name, random.choice(users).id, turn,
+                                           start + timedelta(days=turn, minutes=number))
+        if number >= games:
+            await game_service.mark_game_completed(game_name)
+
+
+def serve(args):
+    """Run the app with uvicorn, pointed at the Mongo stand-in and the stub homeserver."""
+    import uvicorn
+
+    os.chdir(args.workdir)  # creds.conf and matrix.conf are read from the working directory
+    from civ_vi_webhook import api_logger
+    from civ_vi_webhook.main import app
+    from civ_vi_webhook.models.db import mongo_setup
+
+    logging.getLogger().setLevel(logging.WARNING)
+    api_logger.setLevel(logging.WARNING)
+    if args.mongo_url:  # a database of its own, so the benchmark can empty it
+        import motor.motor_asyncio
+        database = motor.motor_asyncio.AsyncIOMotorClient(args.mongo_url)["civ_vi_webhook-benchmark"]
+        mongo_setup.get_database = lambda *_args, **_kwargs: database
+
+    async def seed():
+        if args.mongo_url:
+            for collection in await database.list_collection_names():
+                await database[collection].delete_many({})
+            await mongo_setup.init_db("civ_vi_webhook", "", "", False)
+        await seed_data(args.players, args.games, args.completed_games)
+
+    # added after the app's own startup handlers, so the database is ready
+    app.add_event_handler("startup", seed)
+    uvicorn.run(app, host="127.0.0.1", port=args.port, log_level="warning", access_log=False)
+
+
+def write_config_files(workdir: Path, homeserver_url: str, coalesce_window: float, mongo_url: Optional[str]):
+    (workdir / "creds.conf").write_text(json.dumps({"username": "benchmark", "password": "benchmark",
+                                                    "development_server": False,
+                                                    "database_backend": "mongodb" if mongo_url else "memory",
+                                                    "mongo_url": mongo_url}))
+    (workdir / "matrix.conf").write_text(json.dumps({"server": homeserver_url, "room": "!benchmark:stub",
+                                                     "username": "civ_bot", "password": "benchmark",
+                                                     "coalesce_window": coalesce_window, "min_send_interval": 0}))
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+# ##########
+# Load generator
+# ##########
+
+class TrafficMix:
+    """Builds the requests for each route, keeping turn numbers moving so webhooks aren't dropped as duplicates."""
+
+    def __init__(self, players: int, games: int):
+        self.players = player_names(players)
+        self.games = [f"Seed Game {number}" for number in range(games)] + \
+                     [f"Load Game {number}" for number in range(max(1, games // 4))]
+        self.turns = defaultdict(lambda: 100)
+
+    def next_turn(self) -> tuple[str, str, int]:
+        game_name = random.choice(self.games)
+        self.turns[game_name] += 1
+        return game_name, random.choice(self.players), self.turns[game_name]
+
+    def request(self, route: str) -> tuple[str, str, dict]:
+        """The method, path and aiohttp keyword arguments for a request to the route."""
+        if route == "webhook":
+            game_name, player, turn = self.next_turn()
+            return "POST", "/webhook", {"json": {"value1": game_name, "value2": player, "value3": turn}}
+        if route == "pydt":
+            game_name, player, turn = self.next_turn()
+            return "POST", "/pydt", {"json": {"value1": game_name, "value2": player, "value3": turn,
+                                              "gameName": game_name, "userName": player, "round": turn,
+                                              "civName": "Sumeria", "leaderName": "Gilgamesh"}}
+        if route == "blame":
+            return "GET", "/current_games", {"params": {"player_to_blame": f"@{random.choice(self.players)}:stub"}}
+        if route == "blame_summary":
+            return "GET", "/blame_summary", {"params": {"player_to_blame": f"@{random.choice(self.players)}:stub"}}
+        if route == "completed_games":
+            return "GET", "/completed_games", {"params": {"limit": 50}}
+        if route == "homepage":
+            return "GET", "/", {}
+        return "GET", f"/{route}", {}
+
+
+def parse_mix(mix: str) -> dict[str, int]:
+    weights = {}
+    for entry in mix.split(","):
+        route, weight = entry.split("=")
+        weights[route.strip()] = int(weight)
+    return weights
+
+
+def percentile(sorted_values: list[float], fraction: float) -> float:
+    """Nearest-rank percentile."""
+    index = max(0, min(len(sorted_values) - 1, round(fraction * len(sorted_values) + 0.5) - 1))
+    return sorted_values[index]
+
+
+def summarize(latencies: list[float], errors: int, status_codes: dict, elapsed: float) -> dict:
+    ordered = sorted(latencies)
+    summary = {"count": len(latencies), "errors": errors, "status_codes": dict(status_codes),
+               "throughput_rps": round(len(latencies) / elapsed, 2) if elapsed else None}
+    if ordered:
+        summary["latency_ms"] = {name: round(value * 1000, 3) for name, value in (
+            ("p50", percentile(ordered, 0.50)), ("p95", percentile(ordered, 0.95)),
+            ("p99", percentile(ordered, 0.99)), ("mean", statistics.fmean(ordered)), ("max", ordered[-1]))}
+    return summary
+
+
+async def wait_for_server(session: aiohttp.ClientSession, base_url: str, server: subprocess.Popen, timeout: float):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"The server exited with code {server.returncode} before it was ready.")
+        try:
+            async with session.get(f"{base_url}/total_number_of_games") as response:
+                if response.status == 200 and (await response.json())["total_games"]:
+                    return
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError("The server didn't come up in time.")
+
+
+async def generate_load(session: aiohttp.ClientSession, base_url: str, mix: TrafficMix, weights: dict[str, int],
+                        concurrency: int, number_of_requests: int, record: bool) -> tuple[dict, float]:
+    """Send the requests from `concurrency` workers and time each one."""
+    routes, route_weights = list(weights), list(weights.values())
+    schedule = random.choices(routes, route_weights, k=number_of_requests)
+    next_request = itertools.count()
+    results = defaultdict(lambda: {"latencies": [], "errors": 0, "status_codes": defaultdict(int)})
+
+    async def worker():
+        while (index := next(next_request)) < number_of_requests:
+            route = schedule[index]
+            method, path, kwargs = mix.request(route)
+            started = time.perf_counter()
+            try:
+                async with session.request(method, f"{base_url}{path}", **kwargs) as response:
+                    await response.read()
+                    status = response.status
+            except aiohttp.ClientError:
+                status = None
+            latency = time.perf_counter() - started
+            if record:
+                result = results[route]
+                result["latencies"].append(latency)
+                result["status_codes"][str(status)] += 1
+                if status is None or status >= 500:
+                    result["errors"] += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return results, time.perf_counter() - started
+
+
+def compare(baseline: dict, current: dict) -> list[str]:
+    """Lines describing how each route's p95 latency and throughput moved against the baseline."""
+    lines = []
+    for route, summary in current["routes"].items():
+        old = baseline.get("routes", {}).get(route)
+        if not old or "latency_ms" not in old or "latency_ms" not in summary:
+            continue
+        old_p95, new_p95 = old["latency_ms"]["p95"], summary["latency_ms"]["p95"]
+        change = (new_p95 - old_p95) / old_p95 * 100 if old_p95 else 0
+        lines.append(f"{route:24} p95 {old_p95:9.2f}ms -> {new_p95:9.2f}ms ({change:+.1f}%)")
+    return lines
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_ROOT, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run_benchmark(args) -> dict:
+    random.seed(args.seed)
+    weights = parse_mix(args.mix)
+    homeserver = StubHomeserver(send_delay=args.matrix_delay)
+    homeserver_port, server_port = free_port(), free_port()
+    await homeserver.start(homeserver_port)
+    workdir = Path(tempfile.mkdtemp(prefix="civ_vi_webhook_benchmark_"))
+    write_config_files(workdir, f"http://127.0.0.1:{homeserver_port}", args.coalesce_window, args.mongo_url)
+    server_command = [sys.executable, str(Path(__file__).resolve()), "serve", "--port", str(server_port),
+                      "--workdir", str(workdir), "--players", str(args.players), "--games", str(args.games),
+                      "--completed-games", str(args.completed_games)]
+    if args.mongo_url:
+        server_command += ["--mongo-url", args.mongo_url]
+    server = subprocess.Popen(server_command)
+    base_url = f"http://127.0.0.1:{server_port}"
+    try:
+        connector = aiohttp.TCPConnector(limit=args.concurrency)
+        async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=60)) as session:
+            await wait_for_server(session, base_url, server, args.startup_timeout)
+            mix = TrafficMix(args.players, args.games)
+            if args.warmup:
+                await generate_load(session, base_url, mix, weights, args.concurrency, args.warmup, record=False)
+            results, elapsed = await generate_load(session, base_url, mix, weights, args.concurrency, args.requests,
+                                                   record=True)
+            await asyncio.sleep(args.coalesce_window + 1)  # let the dispatcher drain before counting messages
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+        await homeserver.stop()
+
+    all_latencies = [latency for result in results.values() for latency in result["latencies"]]
+    return {
+        "config": {name: value for name, value in vars(args).items() if name not in ("command", "output", "compare", "port", "workdir")},
+        "environment": {"python": platform.python_version(), "platform": platform.platform(),
+                        "git_commit": git_commit(), "mongo": args.mongo_url or "mongomock-motor"},
+        "started_at": datetime.now().isoformat(timespec="seconds"),
+        "elapsed_seconds": round(elapsed, 3),
+        "overall": summarize(all_latencies, sum(result["errors"] for result in results.values()),
+                             {}, elapsed),
+        "routes": {route: summarize(result["latencies"], result["errors"], result["status_codes"], elapsed)
+                   for route, result in sorted(results.items())},
+        "matrix_messages_received": homeserver.messages_received,
+    }
+
+
+def print_report(report: dict):
+    print(f"{'route':24} {'count':>7} {'errors':>6} {'req/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for route, summary in list(report["routes"].items()) + [("overall", report["overall"])]:
+        latency = summary.get("latency_ms", {})
+        print(f"{route:24} {summary['count']:7} {summary['errors']:6} {summary['throughput_rps'] or 0:8.1f} "
+              f"{latency.get('p50', 0):9.2f} {latency.get('p95', 0):9.2f} {latency.get('p99', 0):9.2f}")
+    print(f"Matrix messages received by the stub homeserver: {report['matrix_messages_received']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", nargs="?", default="run", choices=["run", "serve"],
+                        help="serve is used internally to start the server process")
+    parser.add_argument("--concurrency", type=int, default=10, help="requests in flight at once")
+    parser.add_argument("--requests", type=int, default=1000, help="requests to time")
+    parser.add_argument("--warmup", type=int, default=100, help="requests to send before timing starts")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="route=weight pairs, eg webhook=50,current_games=50")
+    parser.add_argument("--players", type=int, default=6)
+    parser.add_argument("--games", type=int, default=40, help="current games to seed")
+    parser.add_argument("--completed-games", type=int, default=40, help="completed games to seed")
+    parser.add_argument("--mongo-url", help="use this mongod instead of the in-memory stand-in (its "
+                                            "civ_vi_webhook-benchmark database is emptied)")
+    parser.add_argument("--matrix-delay", type=float, default=0.0, help="seconds the stub homeserver takes to send")
+    parser.add_argument("--coalesce-window", type=float, default=1.0)
+    parser.add_argument("--startup-timeout", type=float, default=60.0)
+    parser.add_argument("--seed", type=int, default=0, help="random seed for the traffic mix")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="a previous results file to compare p95 latencies against")
+    parser.add_argument("--port", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--workdir", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        serve(args)
+        return
+    report = asyncio.run(run_benchmark(args))
+    print_report(report)
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            print("\n".join(compare(json.load(baseline_file), report)))
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(report, output_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
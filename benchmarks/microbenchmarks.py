@@ -0,0 +1,305 @@
+"""Time the service-layer functions and count their database round trips at several numbers of games.
+
+Runs against mongomock-motor, so the times are for comparing one version of the code with another, not for
+predicting production latency. The round trip counts are exact: a function whose count grows with the number
+of games (an N+1) shows up straight away.
+
+    python benchmarks/microbenchmarks.py                      # compare with benchmarks/baselines.json
+    python benchmarks/microbenchmarks.py --update-baseline    # after an intended change
+    python benchmarks/microbenchmarks.py --scales 100000 --update-baseline    # add another number of games
+
+Each time is stored as a multiple of a calibration round trip (reading the one game counters document) timed just
+before the benchmark, so the baselines carry over between machines. Exits with 1 if any benchmark has no baseline,
+makes more round trips than its baseline or is slower, relative to the calibration, than the baseline by more than
+the tolerance.
+"""
+import argparse
+import asyncio
+import contextvars
+import functools
+import json
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Awaitable, Callable, NamedTuple, Optional
+from unittest.mock import patch
+
+import mongomock.collection
+
+REPO_ROOT = Path(__file__).resolve().parents[1]
+if str(REPO_ROOT) not in sys.path:
+    sys.path.insert(0, str(REPO_ROOT))
+
+from civ_vi_webhook import api_logger  # noqa: E402
+from civ_vi_webhook import dependencies  # noqa: E402
+from civ_vi_webhook.models.db import mongo_setup  # noqa: E402
+from civ_vi_webhook.models.db.games import (Game, GameCounters,  # noqa: E402
+                                            GameInfo, TurnStatistics)
+from civ_vi_webhook.models.db.turn_events import TurnEvent  # noqa: E402
+from civ_vi_webhook.services.db import game_service  # noqa: E402
+from civ_vi_webhook.services.db import turn_event_service  # noqa: E402
+from civ_vi_webhook.services.db import user_service  # noqa: E402
+
+BASELINE_FILE = Path(__file__).resolve().parent / "baselines.json"
+HISTORY_LENGTH = 2000  # turns in the long-history game
+CALIBRATION_RUNS = 50
+
+# every collection method that is one request to the server
+ROUND_TRIP_METHODS = ["find", "find_one", "aggregate", "insert_one", "insert_many", "update_one", "update_many",
+                      "replace_one", "find_one_and_update", "find_one_and_replace", "find_one_and_delete",
+                      "delete_one", "delete_many", "count_documents", "estimated_document_count", "distinct",
+                      "bulk_write"]
+
+
+class RoundTripCounter:
+    """Counts the requests made to mongomock. Calls mongomock makes internally (eg find_one uses find) aren't counted."""
+
+    def __init__(self):
+        self.count = 0
+        self._inside = contextvars.ContextVar("inside_round_trip", default=False)
+
+    def install(self):
+        for method_name in ROUND_TRIP_METHODS:
+            method = getattr(mongomock.collection.Collection, method_name, None)
+            if method is not None:
+                setattr(mongomock.collection.Collection, method_name, self._counted(method))
+
+    def _counted(self, method):
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            if self._inside.get():
+                return method(*args, **kwargs)
+            self.count += 1
+            token = self._inside.set(True)
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self._inside.reset(token)
+        return wrapper
+
+
+round_trips = RoundTripCounter()
+
+
+class Benchmark(NamedTuple):
+    name: str
+    run: Callable[..., Awaitable]
+    setup: Optional[Callable[[int], Awaitable[tuple]]] = None  # makes the arguments for each run, untimed
+
+
+class Result(NamedTuple):
+    seconds: float
+    round_trips: int
+    relative: float  # seconds divided by the calibration round trip's
+
+
+# ##########
+# Synthetic data
+# ##########
+
+async def seed_database(scale: int):
+    """A fresh in-memory database with `scale` games (a quarter completed), a few players and one long history."""
+    await mongo_setup.init_db("civ_vi_webhook-microbenchmarks", "", "", False, backend="memory")
+    user_service.user_directory.invalidate()
+    random.seed(scale)
+    players = [await user_service.create_user(f"player{number}", matrix_username=f"@player{number}:example.com",
+                                              index_name=f"Player {number}") for number in range(8)]
+    start = datetime.now() - timedelta(days=365)
+    games = []
+    for number in range(scale):
+        turn_deltas = [random.uniform(60, 86400 * 3) for _ in range(20)]
+        games.append(Game(game_name=f"Game {number}",
+                          game_info=GameInfo(next_player_id=random.choice(players).id, turn_number=20,
+                                             game_completed=number % 4 == 0,
+                                             time_stamp_v2=start + timedelta(minutes=number),
+                                             all_players={player.id for player in players[:4]},
+                                             turn_statistics=TurnStatistics.from_turn_deltas(turn_deltas))))
+    # mongomock checks unique indexes by scanning the collection for every document inserted, which makes a bulk
+    # load quadratic. The generated names and ids are unique already. mongomock-motor wraps the check on each
+    # collection, so that's where it is switched off.
+    games_collection = Game.get_motor_collection()._AsyncMongoMockCollection__collection
+    with patch.object(games_collection, "_ensure_uniques"):
+        for start_index in range(0, len(games), 10000):
+            await Game.insert_many(games[start_index:start_index + 10000])
+    await game_service.recount_games()
+    long_game = await Game.find_one(Game.game_name == "Game 1")
+    events = [TurnEvent(player_id=players[turn % 4].id, turn_number=turn,
+                        time_stamp=start + timedelta(hours=turn), turn_delta=3600.0)
+              for turn in range(HISTORY_LENGTH)]
+    await turn_event_service.add_turn_events(long_game.id, events, start)
+    return players
+
+
+# ##########
+# Benchmarks
+# ##########
+
+def benchmarks(players) -> list[Benchmark]:
+    player_id = players[0].id
+    names = (f"Benchmark Game {number}" for number in range(10 ** 9))
+    turn_deltas = [random.uniform(60, 86400) for _ in range(500)]
+
+    async def new_game_name(_iteration):
+        return next(names),
+
+    async def existing_game(_iteration):
+        game_name = next(names)
+        await game_service.record_turn(game_name, player_id, 1, datetime.now())
+        return game_name,
+
+    async def a_game(_iteration):
+        return await Game.find_one(Game.game_name == "Game 2"),
+
+    async def current_games_for_player(_iteration):
+        return await game_service.get_current_games(player_id),
+
+    async def create_game(game_name):
+        await game_service.create_game(game_name, player_id, 1, datetime.now(), turn_deltas)
+
+    async def record_turn_new_game(game_name):
+        await game_service.record_turn(game_name, player_id, 1, datetime.now())
+
+    async def record_turn(game_name):
+        await game_service.record_turn(game_name, players[1].id, 2, datetime.now())
+
+    async def get_current_games_for_player():
+        await game_service.get_current_games(player_id)
+
+    async def get_completed_games():
+        await game_service.get_completed_games()
+
+    async def get_completed_games_page():
+        await game_service.get_completed_games(50)
+
+    async def get_blame_summary():
+        await game_service.get_blame_summary(player_id, datetime.now())
+
+    async def get_game_counts():
+        await game_service.get_game_counts()
+
+    async def get_turn_history():
+        await game_service.get_turn_history("Game 1")
+
+    async def delete_game(game_name):
+        await game_service.delete_game(game_name)
+
+    async def db_model_to_game_model_multiple(these_games):
+        await dependencies.db_model_to_game_model_multiple(these_games)
+
+    async def create_api_game_info(game):
+        await dependencies.create_api_game_info(game)
+
+    async def get_average_turn_time(game):
+        dependencies.get_average_turn_time(game)
+
+    return [
+        Benchmark("game_service.create_game (500 turn deltas)", create_game, new_game_name),
+        Benchmark("game_service.record_turn (new game)", record_turn_new_game, new_game_name),
+        Benchmark("game_service.record_turn", record_turn, existing_game),
+        Benchmark("game_service.get_current_games(player_id)", get_current_games_for_player),
+        Benchmark("game_service.get_completed_games", get_completed_games),
+        Benchmark("game_service.get_completed_games(limit=50)", get_completed_games_page),
+        Benchmark("game_service.get_blame_summary", get_blame_summary),
+        Benchmark("game_service.get_game_counts", get_game_counts),
+        Benchmark(f"game_service.get_turn_history ({HISTORY_LENGTH} turns)", get_turn_history),
+        Benchmark("game_service.delete_game", delete_game, existing_game),
+        Benchmark("dependencies.db_model_to_game_model_multiple (player's current games)",
+                  db_model_to_game_model_multiple, current_games_for_player),
+        Benchmark("dependencies.create_api_game_info", create_api_game_info, a_game),
+        Benchmark("dependencies.get_average_turn_time", get_average_turn_time, a_game),
+    ]
+
+
+async def calibrate() -> float:
+    """The time of a round trip that does next to nothing, to measure the benchmarks against.
+
+    The fastest of several runs is used, here and for the benchmarks, since the slower ones are mostly the machine
+    being busy with something else.
+    """
+    times = []
+    for _ in range(CALIBRATION_RUNS):
+        started = time.perf_counter()
+        await GameCounters.find_one()
+        times.append(time.perf_counter() - started)
+    return min(times)
+
+
+async def measure(benchmark: Benchmark, repeat: int) -> Result:
+    """The fastest of `repeat` runs, and the round trips of one run."""
+    calibration = await calibrate()
+    times, counts = [], []
+    for iteration in range(repeat):
+        arguments = await benchmark.setup(iteration) if benchmark.setup else ()
+        count_before = round_trips.count
+        started = time.perf_counter()
+        await benchmark.run(*arguments)
+        times.append(time.perf_counter() - started)
+        counts.append(round_trips.count - count_before)
+    seconds = min(times)
+    return Result(seconds, max(counts), seconds / calibration)
+
+
+async def run_scale(scale: int, repeat: int) -> dict[str, Result]:
+    players = await seed_database(scale)
+    await user_service.warm_user_cache()
+    return {benchmark.name: await measure(benchmark, repeat) for benchmark in benchmarks(players)}
+
+
+def find_regressions(results: dict, baselines: dict, tolerance: float) -> list[str]:
+    regressions = []
+    for scale, scale_results in results.items():
+        if scale not in baselines:
+            regressions.append(f"no baselines at {scale} games, run with --update-baseline to add them")
+            continue
+        for name, result in scale_results.items():
+            baseline = baselines[scale].get(name)
+            if baseline is None:
+                regressions.append(f"{name} at {scale} games: no baseline, run with --update-baseline to add one")
+                continue
+            if result["round_trips"] > baseline["round_trips"]:
+                regressions.append(f"{name} at {scale} games: {result['round_trips']} round trips, "
+                                   f"baseline {baseline['round_trips']}")
+            if result["relative"] > baseline["relative"] * (1 + tolerance):
+                regressions.append(f"{name} at {scale} games: {result['relative']:.1f} calibration round trips, "
+                                   f"baseline {baseline['relative']:.1f}")
+    return regressions
+
+
+async def main(args) -> int:
+    api_logger.setLevel("WARNING")
+    round_trips.install()
+    results = {}
+    for scale in (int(scale) for scale in args.scales.split(",")):
+        scale_results = await run_scale(scale, args.repeat)
+        results[str(scale)] = {name: {"relative": round(result.relative, 2), "round_trips": result.round_trips}
+                               for name, result in scale_results.items()}
+        print(f"\n{scale} games")
+        for name, result in scale_results.items():
+            print(f"  {name:72} {result.seconds * 1000:10.3f}ms {result.relative:9.1f}x "
+                  f"{result.round_trips:4} round trips")
+
+    baselines = json.loads(BASELINE_FILE.read_text()) if BASELINE_FILE.exists() else {}
+    if args.update_baseline:
+        baselines.update(results)
+        BASELINE_FILE.write_text(json.dumps(baselines, indent=2, sort_keys=True) + "\n")
+        print(f"\nBaselines written to {BASELINE_FILE}")
+        return 0
+    if regressions := find_regressions(results, baselines, args.tolerance):
+        print("\nRegressions:")
+        print("\n".join(f"  {regression}" for regression in regressions))
+        return 1
+    print("\nNo regressions against the baselines.")
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scales", default="10,1000", help="comma separated numbers of games")
+    parser.add_argument("--repeat", type=int, default=5, help="runs of each benchmark; the fastest is used")
+    parser.add_argument("--tolerance", type=float, default=1.0,
+                        help="how much slower than the baseline, relative to the calibration, is allowed, "
+                             "eg 1.0 is twice as slow")
+    parser.add_argument("--update-baseline", action="store_true")
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -0,0 +1,23 @@
+import asyncio
+import sys
+
+from civ_vi_webhook.models.db import mongo_setup
+from civ_vi_webhook.services.db import index_service
+
+
+async def check_indexes() -> int:
+    reports = await index_service.explain_registered_queries()
+    for report in reports:
+        status = "COLLECTION SCAN" if report.regression else "ok"
+        print(f"{status:<16}{report.query.name}: {' <- '.join(report.stages)} {', '.join(report.index_names)}")
+    return sum(report.regression for report in reports)
+
+
+async def main():
+    await mongo_setup.init_db_from_credentials()
+    collection_scans = await check_indexes()
+    sys.exit(1 if collection_scans else 0)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -5,7 +5,6 @@ from civ_vi_webhook import api_logger
 
 from ..dependencies import db_model_to_game_model
 from ..models.api.action_models import CompletedGame, DeletedGame, Error, User
-from ..models.db.user import User as DbUser
 from ..services.db import game_service, user_service
 
 router = APIRouter(tags=['Action Endpoints'])
@@ -15,10 +14,10 @@ router = APIRouter(tags=['Action Endpoints'])
 async def add_user(user: User):
     """Add a user into the database."""
     api_logger.debug(user)
-    db_user = await DbUser.find_one(DbUser.steam_username == user.steam_username)
+    db_user = await user_service.find_user(user.steam_username)
     return db_user or await user_service.create_user(
         user.steam_username,
-        maxtrix_username=user.matrix_username,
+        matrix_username=user.matrix_username,
         index_name=user.index_name,
     )
 
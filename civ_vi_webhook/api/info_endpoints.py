@@ -1,17 +1,23 @@
+from datetime import datetime
 from typing import Optional
 
 import fastapi.responses
-from fastapi import APIRouter, Query
+from fastapi import APIRouter, Query, Request, status
 
-from ..dependencies import db_model_to_game_model_multiple
+from ..dependencies import (cached_response, db_model_to_game_model_multiple,
+                            decode_page_cursor, encode_page_cursor,
+                            stream_games_as_ndjson)
 from ..models.api import information_models
-from ..services.db import game_service, user_service
+from ..services import metrics, tracing
+from ..services.db import game_service, notification_service, user_service
+from ..services.matrix.notification_dispatcher import notification_dispatcher
 
 router = APIRouter(tags=['Information Endpoints'])
 
 
 @router.get('/current_games', response_model=information_models.CurrentGames)
-async def return_current_games(player_to_blame: Optional[str] = Query(None,
+async def return_current_games(request: Request,
+                               player_to_blame: Optional[str] = Query(None,
                                                                       title="Player to Blame",
                                                                       description="To see how many games outstanding.")):
     """Returns the dictionary containing all the games awaiting a turn.
@@ -20,6 +26,11 @@ async def return_current_games(player_to_blame: Optional[str] = Query(None,
 
     Otherwise, it will return a list of all the games outstanding.
     """
+    return await cached_response(request, information_models.CurrentGames,
+                                 lambda: build_current_games(player_to_blame))
+
+
+async def build_current_games(player_to_blame: Optional[str]):
     if player_to_blame:
         player_id = await user_service.get_user_id_from_matrix_username(player_to_blame)
         if player_id:
@@ -33,25 +44,157 @@ async def return_current_games(player_to_blame: Optional[str] = Query(None,
     return {"games": games_to_return}
 
 
+@router.get('/blame_summary', response_model=information_models.BlameSummary)
+async def return_blame_summary(player_to_blame: str = Query(..., title="Player to Blame",
+                                                            description="The Matrix username of the player.")):
+    """Returns the games waiting on a player, how long each has waited, and how many games are current.
+
+    Not cached, since the wait times change every second.
+    """
+    player_id = await user_service.get_user_id_from_matrix_username(player_to_blame)
+    if not player_id:
+        return fastapi.responses.JSONResponse(status_code=404, content={"error": f"{player_to_blame} does not exist"})
+    summary = await game_service.get_blame_summary(player_id, datetime.now())
+    games = [{"game_name": game["game_name"], "turn_number": game["turn_number"],
+              "time_stamp": game["time_stamp"].strftime('%m-%d-%Y %H:%M:%S') if game.get("time_stamp") else None,
+              "wait_seconds": game.get("wait_seconds")}
+             for game in summary["games"]]
+    return {"player_to_blame": player_to_blame,
+            "player_name": await user_service.get_index_name_by_user_id(player_id),
+            "total_current_games": summary["total_current_games"], "games": games}
+
+
+async def return_page_of_games(request: Request, completed: Optional[bool], limit: Optional[int],
+                               cursor: Optional[str], stream: bool):
+    """Return games in order of their last turn, either a page at a time or streamed as NDJSON."""
+    if stream:
+        return await stream_page_of_games(completed, limit, cursor)
+    return await cached_response(request, information_models.CurrentGames,
+                                 lambda: build_page_of_games(completed, limit, cursor))
+
+
+async def stream_page_of_games(completed: Optional[bool], limit: Optional[int], cursor: Optional[str]):
+    try:
+        after = decode_page_cursor(cursor) if cursor else None
+    except ValueError:
+        return fastapi.responses.JSONResponse(status_code=status.HTTP_400_BAD_REQUEST,
+                                              content={"error": f"{cursor} is not a valid cursor."})
+    return fastapi.responses.StreamingResponse(
+        stream_games_as_ndjson(game_service.iterate_games(completed, after, limit)),
+        media_type="application/x-ndjson")
+
+
+async def build_page_of_games(completed: Optional[bool], limit: Optional[int], cursor: Optional[str]):
+    try:
+        after = decode_page_cursor(cursor) if cursor else None
+    except ValueError:
+        return fastapi.responses.JSONResponse(status_code=status.HTTP_400_BAD_REQUEST,
+                                              content={"error": f"{cursor} is not a valid cursor."})
+    if completed is None:
+        these_games = await game_service.get_all_games(limit, after)
+    else:
+        these_games = await game_service.get_completed_games(limit, after)
+    games_to_return = await db_model_to_game_model_multiple(these_games)
+    next_cursor = encode_page_cursor(these_games[-1]) if limit and len(these_games) == limit else None
+    return {"games": games_to_return, "next_cursor": next_cursor}
+
+
+limit_query = Query(None, ge=1, le=1000, title="Page Size", description="Return at most this many games.")
+cursor_query = Query(None, title="Cursor", description="The next_cursor from the previous page.")
+stream_query = Query(False, title="Stream",
+                     description="Stream the games as newline-delimited JSON (application/x-ndjson).")
+
+
 @router.get('/completed_games', response_model=information_models.CurrentGames)
-async def return_completed_games():
-    completed_games = await game_service.get_completed_games()
-    games_to_return = await db_model_to_game_model_multiple(completed_games)
-    return {"games": games_to_return}
+async def return_completed_games(request: Request, limit: Optional[int] = limit_query,
+                                 cursor: Optional[str] = cursor_query, stream: bool = stream_query):
+    """Returns the completed games, oldest last turn first.
+
+    Pass a limit to get the games a page at a time, following next_cursor until it is null.
+    """
+    return await return_page_of_games(request, True, limit, cursor, stream)
 
 
 @router.get('/all_games', response_model=information_models.CurrentGames)
-async def get_all_games():
-    all_games = await game_service.get_all_games()
-    games_to_return = await db_model_to_game_model_multiple(all_games)
-    return {"games": games_to_return}
+async def get_all_games(request: Request, limit: Optional[int] = limit_query, cursor: Optional[str] = cursor_query,
+                        stream: bool = stream_query):
+    """Returns all the games, oldest last turn first.
+
+    Pass a limit to get the games a page at a time, following next_cursor until it is null.
+    """
+    return await return_page_of_games(request, None, limit, cursor, stream)
 
 
 @router.get('/total_number_of_games', response_model=information_models.GameCounts)
-async def return_total_number_of_games():
+async def return_total_number_of_games(request: Request):
     """Returns the total number of games the API knows about."""
-    total_games = await game_service.get_total_game_count()
-    current_games = await game_service.get_current_games_count()
-    completed_games = await game_service.get_completed_games_count()
-    return {'total_games': total_games, 'current_games': current_games,
-            "completed_games": completed_games}
+    return await cached_response(request, information_models.GameCounts, game_service.get_game_counts)
+
+
+@router.get('/turn_history', response_model=information_models.TurnHistory)
+async def return_turn_history(request: Request,
+                              game_name: str = Query(..., title="Game", description="The game to get the turns of.")):
+    """Returns every turn of the game, oldest first."""
+    return await cached_response(request, information_models.TurnHistory, lambda: build_turn_history(game_name))
+
+
+async def build_turn_history(game_name: str):
+    turn_events = await game_service.get_turn_history(game_name)
+    if turn_events is None:
+        return fastapi.responses.JSONResponse(status_code=404, content={"error": f"{game_name} not found."})
+    player_names = await user_service.get_index_names_by_user_ids(event.player_id for event in turn_events
+                                                                  if event.player_id)
+    turns = [{"player_name": player_names.get(event.player_id),
+              "turn_number": event.turn_number,
+              "time_stamp": event.time_stamp.strftime('%m-%d-%Y %H:%M:%S') if event.time_stamp else None,
+              "turn_delta": event.turn_delta}
+             for event in turn_events]
+    return {"game_name": game_name, "turns": turns}
+
+
+@router.get('/notification_queue', response_model=information_models.NotificationQueueStatus)
+async def return_notification_queue_status():
+    """Returns the depth of the notification outbox and how long deliveries have been taking."""
+    oldest_pending = await notification_service.get_oldest_pending()
+    latencies = notification_dispatcher.recent_latencies
+    return {"pending": await notification_service.get_queue_depth(),
+            "failed": await notification_service.get_failed_count(),
+            "oldest_pending_age_seconds": (datetime.now() - oldest_pending.created_at).total_seconds()
+            if oldest_pending else None,
+            "delivered_since_start": notification_dispatcher.delivered_count,
+            "failed_attempts_since_start": notification_dispatcher.failed_attempt_count,
+            "last_delivery_latency_seconds": latencies[-1] if latencies else None,
+            "average_delivery_latency_seconds": sum(latencies) / len(latencies) if latencies else None}
+
+
+@router.get('/metrics', response_class=fastapi.responses.PlainTextResponse)
+async def return_metrics():
+    """Returns request, database call and notification counts and latencies in the Prometheus text format."""
+    return fastapi.responses.PlainTextResponse(metrics.registry.render(),
+                                               media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+def tracing_turned_off_response():
+    return fastapi.responses.JSONResponse(status_code=404, content={"error": "Traces are turned off."})
+
+
+@router.get('/traces', response_model=list[information_models.RequestTrace])
+async def return_recent_traces():
+    """Returns the last few traced requests, newest first.
+
+    Send an X-Trace header (X-Trace: profile to include a cProfile report) to have a request traced.
+    Only available when allow_trace_header is on in creds.conf.
+    """
+    if not tracing.allow_trace_header:
+        return tracing_turned_off_response()
+    return [trace.as_dict() for trace in tracing.recent_traces.all()]
+
+
+@router.get('/traces/{trace_id}', response_model=information_models.RequestTrace)
+async def return_trace(trace_id: str):
+    """Returns the trace named in a response's X-Trace-Id header."""
+    if not tracing.allow_trace_header:
+        return tracing_turned_off_response()
+    if trace := tracing.recent_traces.get(trace_id):
+        return trace.as_dict()
+    return fastapi.responses.JSONResponse(status_code=404, content={"error": f"Trace {trace_id} not found."})
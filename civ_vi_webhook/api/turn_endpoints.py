@@ -1,58 +1,66 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 
 import fastapi.responses
 from fastapi import APIRouter
 from starlette import status
 
 from civ_vi_webhook import api_logger
-from civ_vi_webhook.dependencies import figure_out_base_sixty, figure_out_days
 from civ_vi_webhook.models.api.turns import CivTurnInfo, PYDTTurnInfo
-from civ_vi_webhook.services.db import game_service, user_service
-from civ_vi_webhook.services.matrix import matrix_bot_sender as matrix_bot
+from civ_vi_webhook.services.db import (game_service, notification_service,
+                                        turn_receipt_service, user_service)
+from civ_vi_webhook.services.matrix.notification_dispatcher import \
+    notification_dispatcher
 
 router = APIRouter(tags=['Turn Endpoints'])
 
-# ##########
-# Services
-# ##########
-api_matrix_bot = matrix_bot.MatrixBot()
 
+async def queue_notification(message: str, recipient: str, game_name: str, turn_number: int):
+    """Put the message in the outbox so the endpoint can return without waiting on Matrix.
+
+    It is held for the coalescing window in case more turns for the same player come in.
+    """
+    hold_for = timedelta(seconds=notification_dispatcher.coalesce_window)
+    await notification_service.enqueue_notification(message, recipient=recipient, game_name=game_name,
+                                                    turn_number=turn_number, hold_for=hold_for)
+    notification_dispatcher.wake(after=notification_dispatcher.coalesce_window)
 
-async def turn_delta(this_game: str, current_time: datetime) -> float:
-    """Compute the time delta between the last turn and this turn."""
-    if not await game_service.check_for_game(this_game):
-        return 0
-    game = await game_service.get_game(this_game)
-    return (current_time - game.game_info.time_stamp_v2).total_seconds()
 
+async def record_turn(game_name: str, player_id, turn_number: int, turn_time: datetime):
+    """Create or update a game in the database."""
+    # the turn is stamped once it has the game's lock, so turns arriving together are stamped in the order applied
+    previous_game = await game_service.record_turn(game_name, player_id, turn_number)
+    if previous_game and previous_game.game_info.time_stamp_v2:
+        time_since_last_turn = (turn_time - previous_game.game_info.time_stamp_v2).total_seconds()
+        api_logger.debug(f"{game_name} turn {turn_number} came {time_since_last_turn}s after the last turn.")
 
-def get_average_time(turn_deltas: list) -> str:
-    average_seconds = (sum(turn_deltas) / len(turn_deltas))
-    minutes, seconds = figure_out_base_sixty(average_seconds)
-    hours, minutes = figure_out_base_sixty(minutes)
-    days, hours = figure_out_days(hours)
-    return f"{days} days, {hours} hours, {minutes} min, {seconds:.0f}s."
 
+def duplicate_turn_response(game_name: str, turn_number: int):
+    api_logger.debug(f"Ignoring duplicate notification for {game_name} turn {turn_number}.")
+    return fastapi.responses.JSONResponse(status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                                          content={"status": "Duplicate turn ignored"})
 
-async def create_or_update_game(game_name: str, time_since_last_turn: float, player_id,
-                                turn_number: int, turn_time: datetime):
-    """Create or update a game in the database."""
-    turn_deltas = []
-    continuing_game: bool = await game_service.check_for_game(game_name)
-    if continuing_game:
-        game = await game_service.get_game(game_name)
-        turn_deltas = game.game_info.turn_deltas
-        turn_deltas.append(time_since_last_turn)
-        average_turn_time = get_average_time(turn_deltas)
-        await game_service.update_game(game_name=game_name, player_id=player_id, turn_number=turn_number,
-                                       time_stamp=turn_time, turn_deltas=turn_deltas,
-                                       average_turn_time=average_turn_time)
-    else:
-        turn_deltas.append(time_since_last_turn)
-        average_turn_time = get_average_time(turn_deltas)
-        await game_service.create_game(game_name=game_name, player_id=player_id, turn_number=turn_number,
-                                       time_stamp=turn_time, turn_deltas=turn_deltas,
-                                       average_turn_time=average_turn_time)
+
+async def handle_turn(source: str, game_name: str, steam_username: str, turn_number: int, turn_time: datetime,
+                      message_for_player):
+    """Record the turn and queue its notification, unless the same turn was already handled.
+
+    :param message_for_player: Builds the notification text from the player's name.
+    """
+    # in UTC, which is what the receipts' TTL index compares against
+    if not await turn_receipt_service.claim_turn(game_name, steam_username, turn_number, source, datetime.utcnow()):
+        return duplicate_turn_response(game_name, turn_number)
+    try:
+        player = await user_service.get_user(steam_username)
+        player_name = player.matrix_username or steam_username
+        api_logger.debug(f"{player_name=} if it's the steam username then either no matrix username or not in "
+                         f"database")
+        await record_turn(game_name, player.id, turn_number, turn_time)
+        await queue_notification(message_for_player(player_name), player_name, game_name, turn_number)
+    except Exception:
+        await turn_receipt_service.release_turn(game_name, steam_username, turn_number, source)
+        raise
+    return fastapi.responses.JSONResponse(status_code=status.HTTP_201_CREATED,
+                                          content={"status": "Game Created"})
 
 
 @router.post('/webhook', status_code=status.HTTP_201_CREATED)
@@ -61,39 +69,25 @@ async def handle_play_by_cloud_json(play_by_cloud_game: CivTurnInfo):
 
     The reason for the duplication checks here are in case more than one player has the webhook enabled for all turns.
     That may be desirable because, for example, right now Mac users have crashes when using the webhook.
+    Duplicates of a turn already handled get a 429 without touching the games or sending another message.
     """
     turn_time = datetime.now()
     api_logger.debug(f'JSON from Play By Cloud: {play_by_cloud_game}')
     game_name = play_by_cloud_game.value1
-    time_since_last_turn = await turn_delta(game_name, turn_time)
-    player = await user_service.get_user(play_by_cloud_game.value2)
-    player_name = player.matrix_username or play_by_cloud_game.value2
-    api_logger.debug(f"{player_name=} if it's the steam username then either no matrix username or not in database")
     turn_number = play_by_cloud_game.value3
-    player_id = player.id
-    await create_or_update_game(game_name, time_since_last_turn, player_id, turn_number, turn_time)
-    message = f"Hey, {player_name}, it's your turn in {game_name}. The game is on turn {turn_number}"
-    await api_matrix_bot.send_message(message)
-    return fastapi.responses.JSONResponse(status_code=status.HTTP_201_CREATED,
-                                          content={"status": "Game Created"})
+    return await handle_turn("pbc", game_name, play_by_cloud_game.value2, turn_number, turn_time,
+                             lambda player_name: f"Hey, {player_name}, it's your turn in {game_name}. "
+                                                 f"The game is on turn {turn_number}")
 
 
 @router.post('/pydt', status_code=status.HTTP_201_CREATED)
 async def handle_pydt_json(pydt_game: PYDTTurnInfo):
     api_logger.debug(f'JSON from PYDT: {pydt_game}')
     game_name = pydt_game.gameName
-    player = await user_service.get_user(pydt_game.userName)
-    player_name = player.matrix_username or pydt_game.userName
-    player_id = str(player.id)
-    api_logger.debug(f"{player_name=} if it's the steam username then either no matrix username or not in database")
     turn_number = pydt_game.round
     civ_name = pydt_game.civName
     leader_name = pydt_game.leaderName
-    message = f"Hey, {player_name}, {leader_name} is waiting for you to command {civ_name} in {game_name}. " \
-              f"The game is on turn {turn_number}"
-    await api_matrix_bot.send_message(message)
     turn_time = datetime.now()
-    time_since_last_turn = await turn_delta(game_name, turn_time)
-    await create_or_update_game(game_name, time_since_last_turn, player_id, turn_number, turn_time)
-    return fastapi.responses.JSONResponse(status_code=status.HTTP_201_CREATED,
-                                          content={"status": "Game Created"})
+    return await handle_turn("pydt", game_name, pydt_game.userName, turn_number, turn_time,
+                             lambda player_name: f"Hey, {player_name}, {leader_name} is waiting for you to command "
+                                                 f"{civ_name} in {game_name}. The game is on turn {turn_number}")
@@ -1,17 +1,30 @@
+import base64
+import binascii
+import json
 import math
+from datetime import datetime
 from pathlib import Path
+from typing import AsyncIterator, Awaitable, Callable, Optional
 
 import jinja_partials
+from beanie import PydanticObjectId
+from bson.errors import InvalidId
+from pydantic import BaseModel
+from starlette.requests import Request
+from starlette.responses import Response
 from starlette.templating import Jinja2Templates
 
 from civ_vi_webhook.models.api import games
 from civ_vi_webhook.models.db import games as db_games
 from civ_vi_webhook.services.db import game_service, user_service
+from civ_vi_webhook.services.response_cache import response_cache
 
 BASE_DIR = Path(__file__).resolve().parent
 templates = Jinja2Templates(directory=str(Path(BASE_DIR, 'templates')))
 jinja_partials.register_starlette_extensions(templates)
 
+STREAM_CHUNK_SIZE = 100  # games converted together when streaming NDJSON
+
 
 def figure_out_base_sixty(number: int) -> (int, int):
     """Figure out the next number up if I have more than 59 seconds or minutes."""
@@ -27,27 +40,119 @@ def figure_out_days(number: int) -> (int, int):
     return days, hours
 
 
+def format_turn_time(seconds: float) -> str:
+    """Format a number of seconds as days, hours, minutes and seconds."""
+    minutes, seconds = figure_out_base_sixty(seconds)
+    hours, minutes = figure_out_base_sixty(minutes)
+    days, hours = figure_out_days(hours)
+    return f"{days} days, {hours} hours, {minutes} min, {seconds:.0f}s."
+
+
+def get_average_turn_time(game: db_games.Game) -> Optional[str]:
+    """The game's average turn time, formatted for display."""
+    turn_statistics = game.game_info.turn_statistics
+    if not turn_statistics or not turn_statistics.count:
+        return game.game_info.average_turn_time  # older games stored it preformatted
+    return format_turn_time(turn_statistics.mean)
+
+
 async def db_model_to_game_model_multiple(these_games: list[db_games]) -> list[games]:
+    player_names = await user_service.get_index_names_by_user_ids(game.game_info.next_player_id
+                                                                  for game in these_games)
     games_to_return = []
     for game in these_games:
-        game_info = await create_api_game_info(game)
+        game_info = game_to_api_game_info(game, player_names.get(game.game_info.next_player_id))
         this_game = games.Game(game_name=game.game_name, game_info=game_info)
         games_to_return.append(this_game)
     return games_to_return
 
 
-async def create_api_game_info(game):
+async def stream_games_as_ndjson(these_games: AsyncIterator[db_games.Game],
+                                 chunk_size: int = STREAM_CHUNK_SIZE) -> AsyncIterator[str]:
+    """Convert and write out the games as the database returns them, one JSON document per line.
+
+    The games go out chunk_size at a time, so the player names can be looked up for a whole chunk at once.
+    """
+    chunk = []
+    async for game in these_games:
+        chunk.append(game)
+        if len(chunk) == chunk_size:
+            yield "".join(game.json() + "\n" for game in await db_model_to_game_model_multiple(chunk))
+            chunk = []
+    if chunk:
+        yield "".join(game.json() + "\n" for game in await db_model_to_game_model_multiple(chunk))
+
+
+def encode_page_cursor(game: db_games.Game) -> str:
+    """An opaque cursor pointing just after this game in (time_stamp_v2, id) order."""
+    time_stamp = game.game_info.time_stamp_v2
+    position = {"time_stamp": time_stamp.isoformat() if time_stamp else None, "id": str(game.id)}
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+
+def decode_page_cursor(cursor: str) -> (Optional[datetime], PydanticObjectId):
+    """Turn a cursor from encode_page_cursor back into a (time_stamp_v2, id) position.
+
+    :raises ValueError: If the cursor wasn't made by encode_page_cursor.
+    """
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        time_stamp = datetime.fromisoformat(position["time_stamp"]) if position["time_stamp"] else None
+        return time_stamp, PydanticObjectId(position["id"])
+    except (binascii.Error, json.JSONDecodeError, InvalidId, KeyError, TypeError, UnicodeDecodeError) as error:
+        raise ValueError(f"Invalid cursor: {cursor}") from error
+
+
+def game_to_api_game_info(game, player_name: Optional[str]) -> games.GameInfo:
+    """Convert the DB game info to the API game info, with a player name that has already been looked up.
+
+    List views look up all the player names at once. A player without a name (eg not in the database) stays None.
+    """
     time_stamp = game.game_info.time_stamp_v2.strftime('%m-%d-%Y %H:%M:%S')
+    return games.GameInfo(player_name=player_name, turn_number=game.game_info.turn_number,
+                          game_completed=game.game_info.game_completed, time_stamp=time_stamp,
+                          average_turn_time=get_average_turn_time(game),
+                          winner=game.game_info.winner)
+
+
+async def create_api_game_info(game) -> games.GameInfo:
+    """Convert the DB game info to the API game info for a single game, looking up its player's name."""
     player_name = await user_service.get_index_name_by_user_id(game.game_info.next_player_id)
-    game_info = games.GameInfo(player_name=player_name, turn_number=game.game_info.turn_number,
-                               game_completed=game.game_info.game_completed, time_stamp=time_stamp,
-                               turn_deltas=game.game_info.turn_deltas,
-                               average_turn_time=game.game_info.average_turn_time,
-                               winner=game.game_info.winner)
-    return game_info
+    return game_to_api_game_info(game, player_name)
 
 
 async def db_model_to_game_model(game_to_complete):
     game = await game_service.get_game(game_to_complete)
     game_info = await create_api_game_info(game)
     return games.Game(game_name=game.game_name, game_info=game_info)
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """Whether the client already has this version of the response."""
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    client_etags = {client_etag.strip().removeprefix("W/") for client_etag in if_none_match.split(",")}
+    return etag in client_etags or "*" in client_etags
+
+
+async def cached_response(request: Request, response_model: type[BaseModel],
+                          build_response: Callable[[], Awaitable]) -> Response:
+    """Serve the response from the response cache, building and caching it if needed.
+
+    Clients that send back the current ETag in If-None-Match get a 304 without any database work.
+    If build_response returns a Response (eg a 404) it is passed straight through and not cached.
+    """
+    key = f"{request.url.path}?{sorted(request.query_params.multi_items())}"
+    version = response_cache.version
+    etag = response_cache.etag(key)
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    body = response_cache.get(key)
+    if body is None:
+        result = await build_response()
+        if isinstance(result, Response):
+            return result
+        body = response_model.parse_obj(result).json().encode()
+        response_cache.put(key, body, version)
+    return Response(content=body, media_type="application/json", headers={"ETag": etag})
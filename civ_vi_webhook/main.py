@@ -1,11 +1,15 @@
-import json
+import time
 from pathlib import Path
 
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
 from starlette.staticfiles import StaticFiles
 
+from . import api_logger
 from .api import action_endpoints, info_endpoints, turn_endpoints
 from .models.db import mongo_setup
+from .services import metrics, tracing
+from .services.db import game_service, index_service, user_service
+from .services.matrix.notification_dispatcher import notification_dispatcher
 from .site import homepage
 
 app = FastAPI(
@@ -25,11 +29,65 @@ app.include_router(action_endpoints.router)
 app.include_router(homepage.router)
 
 
+@app.middleware("http")
+async def instrument_request(request: Request, call_next):
+    """Record the request's metrics, and trace it if asked to (see services/tracing.py)."""
+    started = time.perf_counter()
+    status_code = 500
+    trace_header = request.headers.get(tracing.TRACE_HEADER)
+    try:
+        if not tracing.wants_trace(trace_header):
+            response = await call_next(request)
+        else:
+            response = await call_traced(request, call_next, profile=tracing.wants_profile(trace_header))
+        status_code = response.status_code
+        return response
+    finally:
+        route = request.scope.get("route")
+        metrics.observe_request(request.method, getattr(route, "path", None), status_code,
+                                time.perf_counter() - started)
+
+
+async def call_traced(request: Request, call_next, profile: bool):
+    trace = tracing.Trace(request.method, request.url.path)
+    token = tracing.current_trace.set(trace)
+    try:
+        if profile:
+            with tracing.RequestProfile() as request_profile:
+                response = await call_next(request)
+            trace.profile = request_profile.report()
+        else:
+            response = await call_next(request)
+    finally:
+        tracing.current_trace.reset(token)
+        trace.finish()
+        tracing.recent_traces.add(trace)
+    response.headers["Server-Timing"] = trace.server_timing()
+    response.headers["X-Trace-Id"] = trace.trace_id
+    return response
+
+
 @app.on_event("startup")
 async def load_db():
-    with open("creds.conf", "r") as creds:
-        credentials = json.load(creds)
-    await mongo_setup.init_db('civ_vi_webhook',
-                              username=credentials.get("username"),
-                              password=credentials.get("password"),
-                              dev_server=credentials.get("development_server"))
+    credentials = mongo_setup.read_credentials()
+    tracing.configure(credentials.get("trace_sample_rate", 0), credentials.get("allow_trace_header", False))
+    await mongo_setup.init_db_from_credentials(credentials, event_listeners=[tracing.MongoCommandSpans()])
+    await user_service.warm_user_cache()
+    await game_service.recount_games()
+    if credentials.get("database_backend") == "memory":  # mongomock has no query planner to explain with
+        return
+    try:
+        await index_service.report_collection_scans()
+    except Exception as error:  # the check is advisory, don't keep the server from starting
+        api_logger.warning(f"Could not check the query plans: {error!r}")
+
+
+@app.on_event("startup")
+async def start_notification_dispatcher():
+    notification_dispatcher.start()
+
+
+@app.on_event("shutdown")
+async def stop_notifications():
+    await notification_dispatcher.stop()
+    await notification_dispatcher.matrix_bot.close()
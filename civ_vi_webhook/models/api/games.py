@@ -1,15 +1,14 @@
 from typing import Optional
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
 
 class GameInfo(BaseModel):
     """Information about a Game"""
-    player_name: str
+    player_name: Optional[str] = Field(description="The index name of the player the game is waiting on.")
     turn_number: int
     game_completed: Optional[bool]
     time_stamp: str
-    turn_deltas: Optional[list]
     average_turn_time: Optional[str]
     winner: Optional[str]
 
@@ -27,7 +26,6 @@ class Game(BaseModel):
                     "turn_number": 300,
                     "game_completed": False,
                     "time_stamp": "08-26-2022 16:24:40",
-                    "turn_deltas": [24, 6677, 34],
                     "average_turn_time": "0 days, 0 hours, 4 min, 12s.",
                     "winner": "Eric"
                 }
@@ -1,4 +1,6 @@
-from pydantic import BaseModel
+from typing import Optional
+
+from pydantic import BaseModel, Field
 
 from civ_vi_webhook.models.api.games import Game
 
@@ -6,6 +8,7 @@ from civ_vi_webhook.models.api.games import Game
 class CurrentGames(BaseModel):
     """The response to a request for current games."""
     games: list[Game]
+    next_cursor: Optional[str] = Field(description="Pass as the cursor to get the next page. None on the last page.")
 
     class Config:
         schema_extra = {
@@ -46,3 +49,62 @@ class GameCounts(BaseModel):
     total_games: int
     current_games: int
     completed_games: int
+
+
+class NotificationQueueStatus(BaseModel):
+    """The state of the notification outbox."""
+    pending: int
+    failed: int
+    oldest_pending_age_seconds: Optional[float]
+    delivered_since_start: int
+    failed_attempts_since_start: int
+    last_delivery_latency_seconds: Optional[float]
+    average_delivery_latency_seconds: Optional[float]
+
+
+class TurnHistoryEntry(BaseModel):
+    """One turn in a game's history. Turns from before the history was kept only have the delta."""
+    player_name: Optional[str]
+    turn_number: Optional[int]
+    time_stamp: Optional[str]
+    turn_delta: float
+
+
+class TurnHistory(BaseModel):
+    """Every turn the API knows about for a game, oldest first."""
+    game_name: str
+    turns: list[TurnHistoryEntry]
+
+
+class BlameGame(BaseModel):
+    """A game waiting on the blamed player."""
+    game_name: str
+    turn_number: int
+    time_stamp: Optional[str]
+    wait_seconds: Optional[float] = Field(description="How long the game has been waiting for this player.")
+
+
+class BlameSummary(BaseModel):
+    """The games waiting on a player out of all the current games."""
+    player_to_blame: str
+    player_name: Optional[str]
+    total_current_games: int
+    games: list[BlameGame]
+
+
+class TraceSpan(BaseModel):
+    """A service call, Mongo round trip, template render or Matrix send during a traced request."""
+    name: str
+    start_seconds: float = Field(description="When the span started, from the start of the request.")
+    duration_seconds: float
+
+
+class RequestTrace(BaseModel):
+    """Where a traced request's time went."""
+    trace_id: str
+    method: str
+    path: str
+    started_at: str
+    total_seconds: Optional[float]
+    spans: list[TraceSpan]
+    profile: Optional[str] = Field(description="The top of the cProfile report, if X-Trace: profile was sent.")
@@ -18,6 +18,40 @@ class TimeStamp(BaseModel):
     second: int
 
 
+class TurnStatistics(BaseModel):
+    """Running statistics of the time between turns, in seconds.
+
+    Kept up to date one turn at a time with Welford's algorithm, so nothing needs to re-read the turn history.
+    """
+    count: int = 0
+    total: float = 0
+    mean: float = 0
+    m2: float = pydantic.Field(default=0, description="Sum of squared differences from the mean.")
+    minimum: Optional[float]
+    maximum: Optional[float]
+
+    @property
+    def variance(self) -> Optional[float]:
+        return self.m2 / (self.count - 1) if self.count > 1 else None
+
+    def add(self, turn_delta: float):
+        """Add one turn's delta, the same way game_service does it in the database."""
+        self.count += 1
+        self.total += turn_delta
+        previous_mean = self.mean
+        self.mean += (turn_delta - previous_mean) / self.count
+        self.m2 += (turn_delta - previous_mean) * (turn_delta - self.mean)
+        self.minimum = turn_delta if self.minimum is None else min(self.minimum, turn_delta)
+        self.maximum = turn_delta if self.maximum is None else max(self.maximum, turn_delta)
+
+    @classmethod
+    def from_turn_deltas(cls, turn_deltas: list) -> "TurnStatistics":
+        statistics = cls()
+        for turn_delta in turn_deltas:
+            statistics.add(turn_delta)
+        return statistics
+
+
 class GameInfo(BaseModel):
     """Information about a Game"""
     next_player_id: PydanticObjectId = pydantic.Field(description="The MongoDB ID of the player whose turn it now is.")
@@ -26,8 +60,9 @@ class GameInfo(BaseModel):
     time_stamp: Optional[TimeStamp]
     time_stamp_v2: Optional[datetime]
     all_players: set
-    turn_deltas: Optional[list]
-    average_turn_time: Optional[str]
+    turn_deltas: Optional[list] = pydantic.Field(description="Only on games not yet moved to the turn events.")
+    average_turn_time: Optional[str] = pydantic.Field(description="Preformatted average, only on older games.")
+    turn_statistics: Optional[TurnStatistics]
     winner: Optional[str] = pydantic.Field(description="The winner of the game.")
 
 
@@ -38,18 +73,53 @@ class Game(beanie.Document):
     # db.source_collection.copyTo("target_collection") at the database may be the way to move games over
     class Settings:
         name = "games"
-        indexes = ["game_name",
-                   pymongo.IndexModel([("game_info.time_stamp.second", pymongo.DESCENDING),
-                                       ],
-                                      name="last_turn_date_descend")
-                   ]
+        # each index is listed under the game_service functions whose queries it serves (see index_service)
+        indexes = [
+            # get_game, check_for_game, record_turn, mark_game_completed, add_winner_to_game, delete_game
+            # unique so two first turns arriving together can't create the game twice
+            pymongo.IndexModel([("game_name", pymongo.ASCENDING)], name="game_name_unique", unique=True),
+            # get_current_games, get_completed_games
+            pymongo.IndexModel([("game_info.game_completed", pymongo.ASCENDING),
+                                ("game_info.time_stamp_v2", pymongo.ASCENDING),
+                                ("_id", pymongo.ASCENDING)],
+                               name="status_last_turn_id"),
+            # get_all_games
+            pymongo.IndexModel([("game_info.time_stamp_v2", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)],
+                               name="last_turn_id"),
+            # get_current_games(player_id)
+            pymongo.IndexModel([("game_info.game_completed", pymongo.ASCENDING),
+                                ("game_info.next_player_id", pymongo.ASCENDING),
+                                ("game_info.time_stamp_v2", pymongo.ASCENDING)],
+                               name="status_next_player_last_turn")
+        ]
+
+
+class GameCounters(beanie.Document):
+    """The number of games in each state, kept up to date as games are created, completed and deleted."""
+    total_games: int
+    current_games: int
+    completed_games: int
+
+    class Settings:
+        name = "game_counters"
+
+
+class GameId(BaseModel):
+    """Projection for when only the game's id is needed."""
+    id: PydanticObjectId = pydantic.Field(alias="_id")
 
 
 class CompletedGames(beanie.Document):
-    """Contains a list of all completed games for endpoints."""
+    """Contains a list of all completed games for endpoints.
+
+    No longer used, game_info.game_completed is the source of truth. Kept for migrate_game_status_lists.
+    """
     completed_games: list = pydantic.Field(description="list of game IDs")
 
 
 class CurrentGames(beanie.Document):
-    """Contains a list of games current in progress for endpoints."""
+    """Contains a list of games current in progress for endpoints.
+
+    No longer used, game_info.game_completed is the source of truth. Kept for migrate_game_status_lists.
+    """
     current_games: list = pydantic.Field(description="list of game IDs")
@@ -0,0 +1,36 @@
+from datetime import datetime
+from typing import Optional
+
+import beanie
+import pydantic
+import pymongo
+
+DELIVERED_RETENTION_SECONDS = 7 * 24 * 3600
+
+
+class Notification(beanie.Document):
+    """A message waiting in the outbox to be delivered to the chat service.
+
+    Delivered messages are removed by Mongo a week after delivery. Failed ones are kept for looking into.
+    """
+    message: str
+    recipient: Optional[str] = pydantic.Field(description="Who the message is for, so their messages can be merged.")
+    game_name: Optional[str]
+    turn_number: Optional[int]
+    status: str = pydantic.Field(default="pending", description="pending, sending, delivered or failed")
+    attempts: int = 0
+    created_at: datetime
+    next_attempt_at: datetime
+    delivered_at: Optional[datetime]
+    last_error: Optional[str]
+
+    class Settings:
+        name = "notifications"
+        indexes = [pymongo.IndexModel([("status", pymongo.ASCENDING), ("next_attempt_at", pymongo.ASCENDING)],
+                                      name="status_next_attempt"),
+                   # notification_service.claim_pending_for_recipient
+                   pymongo.IndexModel([("status", pymongo.ASCENDING), ("recipient", pymongo.ASCENDING)],
+                                      name="status_recipient"),
+                   pymongo.IndexModel([("delivered_at", pymongo.ASCENDING)], name="delivered_at_ttl",
+                                      expireAfterSeconds=DELIVERED_RETENTION_SECONDS)
+                   ]
@@ -0,0 +1,38 @@
+from datetime import datetime
+from typing import Optional
+
+import beanie
+import pydantic
+import pymongo
+from beanie import PydanticObjectId
+from pydantic import BaseModel
+
+
+class TurnEvent(BaseModel):
+    """One turn of a game.
+
+    Events moved over from the old turn_deltas arrays only have the delta.
+    """
+    player_id: Optional[PydanticObjectId]
+    turn_number: Optional[int]
+    time_stamp: Optional[datetime]
+    turn_delta: float = pydantic.Field(description="Seconds since the previous turn.")
+
+
+class TurnEventBucket(beanie.Document):
+    """A game's turn events for one month, so a game's history is a handful of documents.
+
+    A busy month is split over more than one bucket so no document grows without bound.
+    """
+    game_id: PydanticObjectId
+    bucket_start: Optional[datetime] = pydantic.Field(description="First day of the month. None for migrated events.")
+    event_count: int = 0
+    events: list[TurnEvent] = []
+
+    class Settings:
+        name = "turn_events"
+        indexes = [
+            # turn_event_service.add_turn_event, get_turn_history, delete_turn_history
+            pymongo.IndexModel([("game_id", pymongo.ASCENDING), ("bucket_start", pymongo.ASCENDING)],
+                               name="game_bucket"),
+        ]
@@ -0,0 +1,29 @@
+from datetime import datetime
+
+import beanie
+import pydantic
+import pymongo
+
+DUPLICATE_WINDOW_SECONDS = 3600
+
+
+class TurnReceipt(beanie.Document):
+    """A turn notification that has been handled, so copies sent by other players' webhooks can be ignored.
+
+    Receipts are removed by Mongo once they are older than the duplicate window. TTL indexes read dates as UTC,
+    so received_at is too.
+    """
+    game_name: str
+    player: str = pydantic.Field(description="The Steam username the turn is for, as sent by the webhook.")
+    turn_number: int
+    source: str = pydantic.Field(description="pbc (Play By Cloud) or pydt (Play Your Damn Turn)")
+    received_at: datetime
+
+    class Settings:
+        name = "turn_receipts"
+        indexes = [pymongo.IndexModel([("game_name", pymongo.ASCENDING), ("player", pymongo.ASCENDING),
+                                       ("turn_number", pymongo.ASCENDING), ("source", pymongo.ASCENDING)],
+                                      name="turn_key", unique=True),
+                   pymongo.IndexModel([("received_at", pymongo.ASCENDING)], name="received_at_ttl",
+                                      expireAfterSeconds=DUPLICATE_WINDOW_SECONDS)
+                   ]
@@ -1,6 +1,7 @@
-import beanie
 from typing import Optional
 
+import beanie
+
 
 class User(beanie.Document):
     steam_username: str
@@ -9,3 +10,5 @@ class User(beanie.Document):
 
     class Settings:
         name = "users"
+        # user_service.find_user and the conversion scripts look users up by these
+        indexes = ["steam_username", "matrix_username"]
@@ -1,164 +1,323 @@
+import asyncio
+import weakref
 from datetime import datetime
-from typing import Optional
+from typing import AsyncIterator, Optional
 
-from beanie.operators import In
+from beanie.odm.queries.find import FindMany
+from beanie.operators import In, Set
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
 
 from civ_vi_webhook import api_logger
 
-from ...models.db.games import CompletedGames, CurrentGames, Game, GameInfo
+from ...models.db.games import (CompletedGames, CurrentGames, Game,
+                                GameCounters, GameId, GameInfo, TurnStatistics)
+from ...models.db.turn_events import TurnEvent
+from ..metrics import timed_service_call
+from ..response_cache import bump_data_version
+from . import turn_event_service
 
 
+@timed_service_call
 async def create_game(game_name: str, player_id, turn_number: int, time_stamp: datetime, turn_deltas: list,
-                      average_turn_time: str):
+                      average_turn_time: str = None):
     all_players = {player_id}
     game_info = GameInfo(next_player_id=player_id, turn_number=turn_number, time_stamp_v2=time_stamp,
-                         turn_deltas=turn_deltas, average_turn_time=average_turn_time, all_players=all_players)
+                         turn_statistics=TurnStatistics.from_turn_deltas(turn_deltas),
+                         average_turn_time=average_turn_time, all_players=all_players)
     game = Game(game_name=game_name, game_info=game_info)
     await game.save()
-    await add_game_to_current_games(game.id)
-
-
+    await update_game_counters(total_games=1, current_games=1)
+    bump_data_version()
+    await turn_event_service.add_turn_events(game.id, [TurnEvent(turn_delta=turn_delta) for turn_delta in turn_deltas],
+                                             None)
+
+
+def turn_statistics_from_turn_deltas() -> dict:
+    """An aggregation expression for the statistics of a game's turn_deltas array, as TurnStatistics.from_turn_deltas.
+
+    Only games recorded before the running statistics existed still have the array. For any other game it gives
+    empty statistics.
+    """
+    return {"$let": {
+        "vars": {"deltas": {"$ifNull": ["$game_info.turn_deltas", []]}},
+        "in": {"$let": {
+            "vars": {"mean": {"$ifNull": [{"$avg": "$$deltas"}, 0]}},
+            "in": {"$let": {
+                "vars": {"squared_differences": {"$map": {"input": "$$deltas", "as": "delta",
+                                                          "in": {"$multiply": [{"$subtract": ["$$delta", "$$mean"]},
+                                                                               {"$subtract": ["$$delta", "$$mean"]}]}}}},
+                "in": {"count": {"$size": "$$deltas"},
+                       "total": {"$sum": "$$deltas"},
+                       "mean": "$$mean",
+                       "m2": {"$sum": "$$squared_differences"},
+                       "minimum": {"$min": "$$deltas"},
+                       "maximum": {"$max": "$$deltas"}}}}}}}}
+
+
+def turn_statistics_update(turn_delta: dict) -> dict:
+    """An aggregation expression that adds turn_delta to the game's running turn statistics.
+
+    This is Welford's algorithm, the same as TurnStatistics.add. A game without statistics yet starts from its
+    turn_deltas, so a game that hasn't been backfilled doesn't end up with statistics for only its newest turns.
+    """
+    return {"$let": {
+        "vars": {"statistics": {"$ifNull": ["$game_info.turn_statistics", turn_statistics_from_turn_deltas()]}},
+        "in": {"$let": {
+            "vars": {"delta": turn_delta,
+                     "count": {"$add": ["$$statistics.count", 1]},
+                     "mean": "$$statistics.mean"},
+            "in": {"$let": {
+                "vars": {"new_mean": {"$add": ["$$mean",
+                                               {"$divide": [{"$subtract": ["$$delta", "$$mean"]}, "$$count"]}]}},
+                "in": {"count": "$$count",
+                       "total": {"$add": ["$$statistics.total", "$$delta"]},
+                       "mean": "$$new_mean",
+                       "m2": {"$add": ["$$statistics.m2",
+                                       {"$multiply": [{"$subtract": ["$$delta", "$$mean"]},
+                                                      {"$subtract": ["$$delta", "$$new_mean"]}]}]},
+                       "minimum": {"$min": ["$$statistics.minimum", "$$delta"]},
+                       "maximum": {"$max": ["$$statistics.maximum", "$$delta"]}}}}}}}}
+
+
+_game_write_locks: weakref.WeakValueDictionary[str, asyncio.Lock] = weakref.WeakValueDictionary()
+
+
+def game_write_lock(game_name: str) -> asyncio.Lock:
+    """The lock that puts this process's turns for a game in order. A lock only lives while someone holds it."""
+    lock = _game_write_locks.get(game_name)
+    if lock is None:
+        lock = _game_write_locks[game_name] = asyncio.Lock()
+    return lock
+
+
+@timed_service_call
+async def record_turn(game_name: str, player_id, turn_number: int,
+                      time_stamp: Optional[datetime] = None) -> Optional[Game]:
+    """Record a turn with a single atomic upsert, creating the game if this is its first turn.
+
+    The update is a pipeline so the delta since the previous turn is worked out by the database:
+    it is the equivalent of $set-ing the player, turn number and time stamp, $addToSet-ing the player into
+    all_players and folding the delta into the running turn statistics.
+    The turn itself is then added to the game's turn history.
+
+    Turns for the same game are recorded one at a time so the history is in the order the turns were applied;
+    other games aren't held up. If another process creates the game at the same moment, the unique index
+    on game_name rejects our insert and the turn is applied to their game instead.
+
+    A turn older than the one the game is on (eg one that was held up in another process) is ignored, so it
+    can't put the game back to an earlier player.
+
+    :param time_stamp: When the turn was taken. Leave it out to use the time the game's lock is taken, so this
+        process's turns are stamped in the order they are applied.
+    :returns: The game as it was before this turn (without its turn deltas), or None if the game was just created
+        or the turn was older than the game's.
+    """
+    async with game_write_lock(game_name):
+        return await _record_turn(game_name, player_id, turn_number, time_stamp or datetime.now())
+
+
+async def _record_turn(game_name: str, player_id, turn_number: int, time_stamp: datetime) -> Optional[Game]:
+    previous_time_stamp = "$game_info.time_stamp_v2"
+    turn_delta = {"$divide": [{"$subtract": [time_stamp, previous_time_stamp]}, 1000]}
+    # every expression in a $set stage sees the game as it was before the stage, so these all use the previous
+    # turn's time stamp
+    update = [{"$set": {"game_info.next_player_id": player_id,
+                        "game_info.turn_number": turn_number,
+                        "game_info.game_completed": {"$ifNull": ["$game_info.game_completed", False]},
+                        "game_info.all_players": {"$setUnion": [{"$ifNull": ["$game_info.all_players", []]},
+                                                                [player_id]]},
+                        # the first turn has nothing to be timed against, so it isn't counted
+                        "game_info.turn_statistics": {"$cond": [{"$ifNull": [previous_time_stamp, False]},
+                                                                turn_statistics_update(turn_delta),
+                                                                "$game_info.turn_statistics"]},
+                        "game_info.time_stamp_v2": time_stamp}}]
+    # only a game whose last turn is older than this one (or that doesn't exist yet) is updated
+    game_filter = {"game_name": game_name, "$or": [{"game_info.time_stamp_v2": {"$lt": time_stamp}},
+                                                   {"game_info.time_stamp_v2": None}]}
+    try:
+        previous_game = await Game.get_motor_collection().find_one_and_update(
+            game_filter, update, upsert=True,
+            projection={"game_info.turn_deltas": False}, return_document=ReturnDocument.BEFORE)
+    except DuplicateKeyError:  # the game exists, but either it was just created elsewhere or its last turn is newer
+        previous_game = await Game.get_motor_collection().find_one_and_update(
+            game_filter, update,
+            projection={"game_info.turn_deltas": False}, return_document=ReturnDocument.BEFORE)
+        if not previous_game:
+            api_logger.info(f"Ignored turn {turn_number} of {game_name} from {time_stamp}: "
+                            f"a later turn has already been recorded.")
+            return None
+    if previous_game:
+        previous_game = Game.parse_obj(previous_game)
+        game_id = previous_game.id
+        previous_time_stamp = previous_game.game_info.time_stamp_v2
+    else:
+        game_id = (await Game.find_one(Game.game_name == game_name).project(GameId)).id  # once per game
+        previous_time_stamp = None
+        await update_game_counters(total_games=1, current_games=1)
+    time_since_last_turn = (time_stamp - previous_time_stamp).total_seconds() if previous_time_stamp else 0
+    await turn_event_service.add_turn_event(game_id, TurnEvent(player_id=player_id, turn_number=turn_number,
+                                                               time_stamp=time_stamp,
+                                                               turn_delta=time_since_last_turn))
+    bump_data_version()
+    return previous_game
+
+
+@timed_service_call
 async def check_for_game(game_name: str) -> bool:
     """Check if the game already exists."""
     return bool(await Game.find_one(Game.game_name == game_name))
 
 
+@timed_service_call
 async def get_game(game_name: str) -> Game:
     """Return an existing game."""
     return await Game.find_one(Game.game_name == game_name)
 
 
-async def create_current_games_document(initial_game_id=None):
-    if initial_game_id:
-        current_games_document = CurrentGames(current_games=[initial_game_id])
-    else:
-        current_games_document = CurrentGames(current_games=[])
-    await current_games_document.save()
-
-
-async def add_game_to_current_games(game_id):
-    """Take in a Game ID and add it to the Current Games List."""
-    current_games = await CurrentGames.find_one()
-    if not current_games:
-        await create_current_games_document(game_id)
-    else:
-        current_games.current_games.append(game_id)
-        await current_games.save()
-
-
-async def remove_game_from_current_games(game_id):
-    """Remove a game ID from the current games"""
-    current_games = await CurrentGames.find_one()
-    current_games.current_games.remove(game_id)
-    await current_games.save()
+@timed_service_call
+async def get_turn_history(game_name: str) -> Optional[list[TurnEvent]]:
+    """Return every turn of the game, oldest first, or None if there's no such game."""
+    game = await Game.find_one(Game.game_name == game_name).project(GameId)
+    return await turn_event_service.get_turn_history(game.id) if game else None
 
 
+@timed_service_call
 async def get_current_games(player_id: str = None) -> Optional[list[Game]]:
     """Get the current games (perhaps waiting on a specific player)."""
-    current_games_document = await CurrentGames.find_one()
-    games = await Game.find(In(Game.id, current_games_document.current_games)).sort(Game.game_info.time_stamp_v2).to_list()
-    return [game for game in games if game.game_info.next_player_id == player_id] if player_id else games
-
-
-async def create_completed_games_document(initial_game_id=None):
-    if initial_game_id:
-        completed_games = CompletedGames(completed_games=[initial_game_id])
-        await remove_game_from_current_games(initial_game_id)
-    else:
-        completed_games = CompletedGames(completed_games=[])
-    await completed_games.save()
-
-
-async def update_game(game_name: str, player_id, turn_number: int, time_stamp: datetime, turn_deltas: list,
-                      average_turn_time: str):
-    game = await Game.find_one(Game.game_name == game_name)
-    all_players = game.game_info.all_players
-    all_players.add(player_id)
-    game_info = GameInfo(next_player_id=player_id, turn_number=turn_number, time_stamp_v2=time_stamp,
-                         turn_deltas=turn_deltas, average_turn_time=average_turn_time, all_players=all_players)
-    game.game_info = game_info
-    await game.save()
-
-
-async def add_game_to_finished_games(game_id):
-    completed_games = await CompletedGames.find_one()
-    if not completed_games:
-        await create_completed_games_document(game_id)
-    else:
-        completed_games.completed_games.append(game_id)
-        await completed_games.save()
-        await remove_game_from_current_games(game_id)
-
-
+    query = Game.find(Game.game_info.game_completed == False)  # noqa: E712
+    if player_id:
+        query = query.find(Game.game_info.next_player_id == player_id)
+    return await query.sort(Game.game_info.time_stamp_v2).to_list()
+
+
+@timed_service_call
+async def get_blame_summary(player_id, now: datetime) -> dict:
+    """The current games waiting on a player, with how long each has waited, and the count of all current games.
+
+    One aggregation: the leading $match uses the status index, then a $facet splits out the player's games.
+    """
+    facets = await Game.get_motor_collection().aggregate([
+        {"$match": {"game_info.game_completed": False}},
+        {"$facet": {
+            "games": [{"$match": {"game_info.next_player_id": player_id}},
+                      {"$sort": {"game_info.time_stamp_v2": 1}},
+                      {"$project": {"_id": 0, "game_name": 1, "turn_number": "$game_info.turn_number",
+                                    "time_stamp": "$game_info.time_stamp_v2",
+                                    "wait_seconds": {"$divide": [{"$subtract": [now, "$game_info.time_stamp_v2"]},
+                                                                 1000]}}}],
+            "total_current_games": [{"$count": "count"}],
+        }},
+    ]).to_list(length=1)
+    total = facets[0]["total_current_games"]
+    return {"games": facets[0]["games"], "total_current_games": total[0]["count"] if total else 0}
+
+
+@timed_service_call
 async def mark_game_completed(game_name: str):
-    game = await Game.find_one(Game.game_name == game_name)
-    game.game_info.game_completed = True
-    await game.save()
-    await add_game_to_finished_games(game.id)
+    result = await Game.get_motor_collection().update_one(
+        {"game_name": game_name, "game_info.game_completed": False}, {"$set": {"game_info.game_completed": True}})
+    if result.modified_count:
+        await update_game_counters(current_games=-1, completed_games=1)
+        bump_data_version()
 
 
+@timed_service_call
 async def add_winner_to_game(game_name: str, winner: str):
-    game = await Game.find_one(Game.game_name == game_name)
-    game.game_info.winner = winner
-    await game.save()
-
-
-async def get_total_game_count() -> int:
-    """A count of all the games in the database."""
-    return await Game.find().count()
-
-
-async def get_current_games_count() -> int:
-    """A count of all the games in progress in the database."""
-    current_games_document = await CurrentGames.find_one()
-    return await Game.find(In(Game.id, current_games_document.current_games)).count()
-
-
-async def get_completed_games_count() -> int:
-    """A count of all the games that are completed."""
-    completed_games_document = await CompletedGames.find_one()
-    if not completed_games_document:
-        await create_completed_games_document()
-        return 0
-    return await Game.find(In(Game.id, completed_games_document.completed_games)).count()
-
-
-async def get_completed_games() -> list[Game]:
-    """Get the current games (perhaps waiting on a specific player)."""
-    completed_games_document = await CompletedGames.find_one()
-    if completed_games_document:
-        games = await Game.find(In(Game.id, completed_games_document.completed_games)).sort(Game.game_info.time_stamp_v2).to_list()
-        return games
-    else:
-        return []
-
-
-async def remove_game_from_completed_games(game_id):
-    """Remove a game ID from the completed games"""
-    completed_games = await CompletedGames.find_one()
-    completed_games.completed_games.remove(game_id)
-    await completed_games.save()
-
-
-async def get_all_games() -> list[Game]:
-    """Get all the games in the database"""
-    return await Game.find().to_list()
-
-
+    # only touch the winner so a turn being recorded at the same time isn't overwritten
+    await Game.get_motor_collection().update_one({"game_name": game_name}, {"$set": {"game_info.winner": winner}})
+    bump_data_version()
+
+
+@timed_service_call
+async def count_games() -> dict:
+    """Count the total, current and completed games with one aggregation."""
+    count = [{"$count": "count"}]
+    facets = await Game.get_motor_collection().aggregate([{"$facet": {
+        "total_games": count,
+        "current_games": [{"$match": {"game_info.game_completed": False}}] + count,
+        "completed_games": [{"$match": {"game_info.game_completed": True}}] + count,
+    }}]).to_list(length=1)
+    return {name: facet[0]["count"] if facet else 0 for name, facet in facets[0].items()}
+
+
+@timed_service_call
+async def recount_games() -> dict:
+    """Reset the game counters from the games themselves. Called at startup in case anything drifted."""
+    counts = await count_games()
+    await GameCounters.get_motor_collection().replace_one({}, counts, upsert=True)
+    return counts
+
+
+@timed_service_call
+async def update_game_counters(**changes: int):
+    """Add the changes to the counters, eg update_game_counters(total_games=1, current_games=1)."""
+    await GameCounters.get_motor_collection().update_one({}, {"$inc": changes})
+
+
+@timed_service_call
+async def get_game_counts() -> dict:
+    """The number of total, current and completed games from the maintained counters."""
+    counters = await GameCounters.find_one()
+    if counters is None:
+        return await recount_games()
+    return {"total_games": counters.total_games, "current_games": counters.current_games,
+            "completed_games": counters.completed_games}
+
+
+def games_page_query(completed: Optional[bool] = None, after: Optional[tuple] = None,
+                     limit: Optional[int] = None) -> FindMany[Game]:
+    """A query for games in (time_stamp_v2, id) order, optionally only those with the given status.
+
+    :param after: The (time_stamp_v2, id) of the last game on the previous page, to carry on after it.
+    """
+    query = Game.find() if completed is None else Game.find(Game.game_info.game_completed == completed)
+    if after:
+        time_stamp, game_id = after
+        if time_stamp is None:  # nulls sort first, so everything with a time stamp comes after
+            later_time_stamp = {"game_info.time_stamp_v2": {"$ne": None}}
+        else:
+            later_time_stamp = {"game_info.time_stamp_v2": {"$gt": time_stamp}}
+        query = query.find({"$or": [later_time_stamp,
+                                    {"game_info.time_stamp_v2": time_stamp, "_id": {"$gt": game_id}}]})
+    query = query.sort(Game.game_info.time_stamp_v2, Game.id)
+    return query.limit(limit) if limit else query
+
+
+@timed_service_call
+async def get_completed_games(limit: Optional[int] = None, after: Optional[tuple] = None) -> list[Game]:
+    """Get the completed games, a page at a time if there's a limit."""
+    return await games_page_query(True, after, limit).to_list()
+
+
+async def iterate_games(completed: Optional[bool] = None, after: Optional[tuple] = None,
+                        limit: Optional[int] = None) -> AsyncIterator[Game]:
+    """Yield the games one at a time as the cursor returns them, rather than loading them all first."""
+    async for game in games_page_query(completed, after, limit):
+        yield game
+
+
+@timed_service_call
+async def get_all_games(limit: Optional[int] = None, after: Optional[tuple] = None) -> list[Game]:
+    """Get all the games in the database, a page at a time if there's a limit."""
+    return await games_page_query(None, after, limit).to_list()
+
+
+@timed_service_call
 async def delete_game(game_name: str) -> bool:
     """Delete a game from the database"""
-    game_exists = await check_for_game(game_name)
-    if not game_exists:
+    # find_one_and_delete hands back the id the turn history is kept under, in the same round trip as the delete
+    deleted_game = await Game.get_motor_collection().find_one_and_delete(
+        {"game_name": game_name}, projection={"game_info.game_completed": True})
+    if not deleted_game:
         return False
-    api_logger.debug("Game found, about to delete.")
-    game_to_delete = await Game.find_one(Game.game_name == game_name)
-    if game_to_delete.game_info.game_completed:
-        api_logger.debug("Game had been marked as completed, removing from that list.")
-        await remove_game_from_completed_games(game_to_delete.id)
+    api_logger.debug("Game found and deleted.")
+    await turn_event_service.delete_turn_history(deleted_game["_id"])
+    if deleted_game["game_info"].get("game_completed"):
+        await update_game_counters(total_games=-1, completed_games=-1)
     else:
-        api_logger.debug("Game was not completed, removing from current games list.")
-        await remove_game_from_current_games(game_to_delete.id)
-    await game_to_delete.delete()
+        await update_game_counters(total_games=-1, current_games=-1)
+    bump_data_version()
     return True
 
 
@@ -175,3 +334,43 @@ async def convert_to_new_time_stamp():
                                   game.game_info.time_stamp.second)
             game.game_info.time_stamp_v2 = time_stamp
         await game.save()
+
+
+async def backfill_turn_statistics():
+    """Compute the running turn statistics for games recorded before they existed."""
+    games = await Game.find(Game.game_info.turn_statistics == None).to_list()  # noqa: E711
+    for game in games:
+        turn_statistics = TurnStatistics.from_turn_deltas(game.game_info.turn_deltas or [])
+        update = {"$set": {"game_info.turn_statistics": turn_statistics.dict()}}
+        if turn_statistics.count:
+            # the preformatted average is only needed while there are no statistics to show instead
+            update["$unset"] = {"game_info.average_turn_time": ""}
+        await Game.get_motor_collection().update_one({"_id": game.id}, update)
+
+
+async def migrate_game_status_lists():
+    """Move the game status off the old CurrentGames and CompletedGames documents and onto each game."""
+    if completed_games_document := await CompletedGames.find_one():
+        await Game.find(In(Game.id, completed_games_document.completed_games)).update(
+            Set({Game.game_info.game_completed: True}))
+        await completed_games_document.delete()
+    if current_games_document := await CurrentGames.find_one():
+        await Game.find(In(Game.id, current_games_document.current_games)).update(
+            Set({Game.game_info.game_completed: False}))
+        await current_games_document.delete()
+    await recount_games()
+
+
+async def migrate_turn_deltas_to_events():
+    """Move the turn_deltas arrays off the games and into the turn events collection.
+
+    Safe to run again if it stopped part way: a game whose turn_deltas are still there has any events from the
+    earlier run replaced.
+    """
+    await backfill_turn_statistics()  # needs the deltas, so make sure it has happened first
+    games = await Game.find({"game_info.turn_deltas": {"$exists": True}}).to_list()
+    for game in games:
+        events = [TurnEvent(turn_delta=turn_delta) for turn_delta in game.game_info.turn_deltas or []]
+        await turn_event_service.delete_migrated_turn_events(game.id)
+        await turn_event_service.add_turn_events(game.id, events, None)
+        await Game.get_motor_collection().update_one({"_id": game.id}, {"$unset": {"game_info.turn_deltas": ""}})
@@ -0,0 +1,109 @@
+"""Check that the queries the services run are served by the indexes declared on the models.
+
+The indexes themselves are declared in each model's Settings and created by mongo_setup.init_db.
+"""
+from datetime import datetime
+from typing import NamedTuple, Optional
+
+import beanie
+from bson import ObjectId
+
+from civ_vi_webhook import api_logger
+
+from ...models.db.games import Game
+from ...models.db.notifications import Notification
+from ...models.db.turn_receipts import TurnReceipt
+from ...models.db.user import User
+
+
+class RegisteredQuery(NamedTuple):
+    """A query run by one of the services, in the shape it is sent to Mongo."""
+    name: str
+    model: type[beanie.Document]
+    query_filter: dict
+    sort: Optional[list] = None
+    collection_scan_expected: bool = False
+
+
+REGISTERED_QUERIES = [
+    RegisteredQuery("game_service.get_game", Game, {"game_name": "game"}),
+    RegisteredQuery("game_service.get_current_games", Game, {"game_info.game_completed": False},
+                    [("game_info.time_stamp_v2", 1)]),
+    RegisteredQuery("game_service.get_current_games(player_id)", Game,
+                    {"game_info.game_completed": False, "game_info.next_player_id": ObjectId()},
+                    [("game_info.time_stamp_v2", 1)]),
+    # the leading $match of the get_blame_summary aggregation
+    RegisteredQuery("game_service.get_blame_summary", Game, {"game_info.game_completed": False}),
+    RegisteredQuery("game_service.get_completed_games", Game, {"game_info.game_completed": True},
+                    [("game_info.time_stamp_v2", 1), ("_id", 1)]),
+    RegisteredQuery("game_service.get_all_games", Game, {}, [("game_info.time_stamp_v2", 1), ("_id", 1)]),
+    RegisteredQuery("game_service.get_all_games(after)", Game,
+                    {"$or": [{"game_info.time_stamp_v2": {"$gt": datetime.now()}},
+                             {"game_info.time_stamp_v2": datetime.now(), "_id": {"$gt": ObjectId()}}]},
+                    [("game_info.time_stamp_v2", 1), ("_id", 1)]),
+    RegisteredQuery("user_service.find_user", User, {"steam_username": "steam"}),
+    RegisteredQuery("user_service.get_index_names_by_user_ids", User, {"_id": {"$in": [ObjectId()]}}),
+    RegisteredQuery("user_service.UserDirectory.load", User, {}, collection_scan_expected=True),
+    RegisteredQuery("notification_service.claim_pending_for_recipient", Notification,
+                    {"status": "pending", "recipient": "player"}),
+    RegisteredQuery("turn_receipt_service.claim_turn", TurnReceipt,
+                    {"game_name": "game", "player": "steam", "turn_number": 1, "source": "pbc",
+                     "received_at": {"$lt": datetime.now()}}),
+    RegisteredQuery("notification_service.claim_next_notification", Notification,
+                    {"status": "pending", "next_attempt_at": {"$lte": datetime.now()}}, [("next_attempt_at", 1)]),
+]
+
+
+class QueryPlanReport(NamedTuple):
+    query: RegisteredQuery
+    stages: list[str]
+    index_names: list[str]
+
+    @property
+    def collection_scan(self) -> bool:
+        return "COLLSCAN" in self.stages
+
+    @property
+    def regression(self) -> bool:
+        return self.collection_scan and not self.query.collection_scan_expected
+
+
+def _plan_stages(plan: dict, stages: list, index_names: list):
+    """Walk a winning plan, collecting the stage names and the indexes used."""
+    if stage := plan.get("stage"):
+        stages.append(stage)
+    if index_name := plan.get("indexName"):
+        index_names.append(index_name)
+    for key in ("inputStage", "queryPlan", "outerStage", "innerStage"):
+        if key in plan:
+            _plan_stages(plan[key], stages, index_names)
+    for input_stage in plan.get("inputStages", []):
+        _plan_stages(input_stage, stages, index_names)
+
+
+async def explain_query(query: RegisteredQuery) -> QueryPlanReport:
+    cursor = query.model.get_motor_collection().find(query.query_filter)
+    if query.sort:
+        cursor = cursor.sort(query.sort)
+    explanation = await cursor.explain()
+    stages, index_names = [], []
+    _plan_stages(explanation["queryPlanner"]["winningPlan"], stages, index_names)
+    return QueryPlanReport(query, stages, index_names)
+
+
+async def explain_registered_queries() -> list[QueryPlanReport]:
+    return [await explain_query(query) for query in REGISTERED_QUERIES]
+
+
+async def report_collection_scans() -> list[QueryPlanReport]:
+    """Log any registered query that the query planner answers with a collection scan.
+
+    :returns: The reports for the queries that scan the collection when they shouldn't.
+    """
+    reports = await explain_registered_queries()
+    for report in reports:
+        if report.regression:
+            api_logger.warning(f"{report.query.name} does a collection scan: {' <- '.join(report.stages)}")
+        else:
+            api_logger.debug(f"{report.query.name}: {' <- '.join(report.stages)} {report.index_names}")
+    return [report for report in reports if report.regression]
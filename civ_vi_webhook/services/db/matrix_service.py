@@ -1,15 +1,14 @@
+from typing import Optional
+
 from ...models.db.matrix import Matrix
 
 
 async def write_next_batch(next_batch: str):
     """Write the next batch info for the Matrix listener."""
-    # matrix = Matrix(next_batch=next_batch)
-    matrix = await Matrix.find_one()
-    matrix.next_batch = next_batch
-    await matrix.save()
+    await Matrix.get_motor_collection().update_one({}, {"$set": {"next_batch": next_batch}}, upsert=True)
 
 
-async def get_next_batch() -> str:
+async def get_next_batch() -> Optional[str]:
     """Get the next batch info for the Matrix listener"""
     matrix = await Matrix.find_one()
-    return matrix.next_batch
+    return matrix.next_batch if matrix else None
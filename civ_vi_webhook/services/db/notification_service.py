@@ -0,0 +1,81 @@
+from datetime import datetime, timedelta
+from typing import Optional
+
+from pymongo import ReturnDocument
+
+from ...models.db.notifications import Notification
+
+
+async def enqueue_notification(message: str, recipient: Optional[str] = None, game_name: Optional[str] = None,
+                               turn_number: Optional[int] = None,
+                               hold_for: timedelta = timedelta(0)) -> Notification:
+    """Put a message in the outbox for the dispatcher to deliver.
+
+    :param hold_for: How long to wait before sending, so other messages for the recipient can be merged with it.
+    """
+    now = datetime.now()
+    notification = Notification(message=message, recipient=recipient, game_name=game_name, turn_number=turn_number,
+                                created_at=now, next_attempt_at=now + hold_for)
+    await notification.save()
+    return notification
+
+
+async def claim_next_notification(now: datetime) -> Optional[Notification]:
+    """Atomically move the oldest due notification from pending to sending and return it."""
+    collection = Notification.get_motor_collection()
+    document = await collection.find_one_and_update(
+        {"status": "pending", "next_attempt_at": {"$lte": now}},
+        {"$set": {"status": "sending"}, "$inc": {"attempts": 1}},
+        sort=[("next_attempt_at", 1)],
+        return_document=ReturnDocument.AFTER,
+    )
+    return Notification.parse_obj(document) if document else None
+
+
+async def claim_pending_for_recipient(recipient: str) -> list[Notification]:
+    """Move all of a recipient's pending notifications, due or not, to sending and return them oldest first."""
+    collection = Notification.get_motor_collection()
+    pending = collection.find({"status": "pending", "recipient": recipient}, {"_id": 1})
+    ids = [document["_id"] async for document in pending]
+    if not ids:
+        return []
+    await collection.update_many({"_id": {"$in": ids}, "status": "pending"},
+                                 {"$set": {"status": "sending"}, "$inc": {"attempts": 1}})
+    claimed = collection.find({"_id": {"$in": ids}, "status": "sending"}).sort("created_at", 1)
+    return [Notification.parse_obj(document) async for document in claimed]
+
+
+async def mark_delivered(notifications: list[Notification], delivered_at: datetime):
+    await Notification.get_motor_collection().update_many(
+        {"_id": {"$in": [notification.id for notification in notifications]}},
+        {"$set": {"status": "delivered", "delivered_at": delivered_at, "last_error": None}})
+
+
+async def mark_failed(notifications: list[Notification], error: str, retry_in: Optional[timedelta]):
+    """Record a failed attempt. Without a retry delay the notifications are given up on."""
+    if retry_in is None:
+        update = {"status": "failed", "last_error": error}
+    else:
+        update = {"status": "pending", "last_error": error, "next_attempt_at": datetime.now() + retry_in}
+    await Notification.get_motor_collection().update_many(
+        {"_id": {"$in": [notification.id for notification in notifications]}}, {"$set": update})
+
+
+async def requeue_interrupted_notifications() -> int:
+    """Put back notifications that were being sent when the server last stopped."""
+    collection = Notification.get_motor_collection()
+    result = await collection.update_many({"status": "sending"}, {"$set": {"status": "pending"}})
+    return result.modified_count
+
+
+async def get_queue_depth() -> int:
+    """A count of the notifications not yet delivered or given up on."""
+    return await Notification.find({"status": {"$in": ["pending", "sending"]}}).count()
+
+
+async def get_failed_count() -> int:
+    return await Notification.find({"status": "failed"}).count()
+
+
+async def get_oldest_pending() -> Optional[Notification]:
+    return await Notification.find({"status": {"$in": ["pending", "sending"]}}).sort("created_at").first_or_none()
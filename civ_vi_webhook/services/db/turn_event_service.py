@@ -0,0 +1,43 @@
+from datetime import datetime
+from typing import Optional
+
+from ...models.db.turn_events import TurnEvent, TurnEventBucket
+
+MAX_EVENTS_PER_BUCKET = 200
+
+
+def bucket_start(time_stamp: Optional[datetime]) -> Optional[datetime]:
+    """The bucket a turn at this time goes in."""
+    return time_stamp.replace(day=1, hour=0, minute=0, second=0, microsecond=0) if time_stamp else None
+
+
+async def add_turn_events(game_id, events: list[TurnEvent], time_stamp: Optional[datetime]):
+    """Append the events to the game's bucket for time_stamp, starting a new bucket when it fills up."""
+    collection = TurnEventBucket.get_motor_collection()
+    for start in range(0, len(events), MAX_EVENTS_PER_BUCKET):
+        chunk = events[start:start + MAX_EVENTS_PER_BUCKET]
+        await collection.update_one(
+            {"game_id": game_id, "bucket_start": bucket_start(time_stamp),
+             "event_count": {"$lte": MAX_EVENTS_PER_BUCKET - len(chunk)}},
+            {"$push": {"events": {"$each": [event.dict() for event in chunk]}}, "$inc": {"event_count": len(chunk)}},
+            upsert=True)
+
+
+async def add_turn_event(game_id, event: TurnEvent):
+    await add_turn_events(game_id, [event], event.time_stamp)
+
+
+async def get_turn_history(game_id) -> list[TurnEvent]:
+    """All the turns of a game, oldest first."""
+    buckets = await TurnEventBucket.find(TurnEventBucket.game_id == game_id).sort(
+        TurnEventBucket.bucket_start, TurnEventBucket.id).to_list()
+    return [event for bucket in buckets for event in bucket.events]
+
+
+async def delete_migrated_turn_events(game_id):
+    """Delete the events moved over from the game's turn_deltas, which are the ones in the undated bucket."""
+    await TurnEventBucket.find({"game_id": game_id, "bucket_start": None}).delete()
+
+
+async def delete_turn_history(game_id):
+    await TurnEventBucket.find(TurnEventBucket.game_id == game_id).delete()
@@ -0,0 +1,71 @@
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from pymongo.errors import DuplicateKeyError
+
+from ...models.db.turn_receipts import DUPLICATE_WINDOW_SECONDS, TurnReceipt
+
+
+class RecentTurns:
+    """The turns handled recently by this process, so most duplicates are spotted without a database call.
+
+    Every key lives for the same TTL, so insertion order is expiry order and expired keys are pruned from the front.
+    """
+
+    def __init__(self, ttl_seconds: float = DUPLICATE_WINDOW_SECONDS, max_entries: int = 1024):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._expiries: OrderedDict[tuple, float] = OrderedDict()
+
+    def _prune(self, now: float):
+        while len(self._expiries) > self.max_entries:
+            self._expiries.popitem(last=False)
+        while self._expiries and next(iter(self._expiries.values())) <= now:
+            self._expiries.popitem(last=False)
+
+    def __contains__(self, key: tuple) -> bool:
+        self._prune(time.monotonic())
+        return key in self._expiries
+
+    def add(self, key: tuple):
+        now = time.monotonic()
+        self._expiries.pop(key, None)
+        self._expiries[key] = now + self.ttl_seconds
+        self._prune(now)
+
+    def discard(self, key: tuple):
+        self._expiries.pop(key, None)
+
+
+recent_turns = RecentTurns()
+
+
+async def claim_turn(game_name: str, player: str, turn_number: int, source: str, received_at: datetime) -> bool:
+    """Record that this turn is being handled. Returns False if it was already handled within the duplicate window.
+
+    The unique index on the receipts makes this safe across processes. A receipt older than the window that Mongo
+    hasn't expired yet is taken over rather than counted as a duplicate.
+    """
+    key = (game_name, player, turn_number, source)
+    if key in recent_turns:
+        return False
+    cutoff = received_at - timedelta(seconds=DUPLICATE_WINDOW_SECONDS)
+    try:
+        await TurnReceipt.get_motor_collection().update_one(
+            {"game_name": game_name, "player": player, "turn_number": turn_number, "source": source,
+             "received_at": {"$lt": cutoff}},
+            {"$set": {"received_at": received_at}},
+            upsert=True)
+    except DuplicateKeyError:
+        recent_turns.add(key)
+        return False
+    recent_turns.add(key)
+    return True
+
+
+async def release_turn(game_name: str, player: str, turn_number: int, source: str):
+    """Forget a claimed turn that couldn't be recorded, so the webhook's retry isn't thrown away."""
+    recent_turns.discard((game_name, player, turn_number, source))
+    await TurnReceipt.get_motor_collection().delete_one(
+        {"game_name": game_name, "player": player, "turn_number": turn_number, "source": source})
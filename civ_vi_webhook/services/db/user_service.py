@@ -1,6 +1,64 @@
+import time
+from typing import Optional
+
+from beanie.operators import In
+
 from ...models.db.user import User
+from ..metrics import timed_service_call
+from ..response_cache import bump_data_version
+
+
+class UserDirectory:
+    """An in-memory copy of the users collection, indexed by id, Steam username and Matrix username.
+
+    The collection is tiny and rarely changes, so lookups are served from here.
+    Users created through this module are added as they are saved. The whole directory is reloaded
+    once it is older than the TTL in case users were added some other way (eg the conversion scripts).
+    Ids that weren't in the database are remembered until then too, so they aren't looked up on every request.
+    """
+
+    def __init__(self, ttl_seconds: float = 600):
+        self.ttl_seconds = ttl_seconds
+        self.by_id: dict = {}
+        self.by_steam_username: dict[str, User] = {}
+        self.by_matrix_username: dict[str, User] = {}
+        self.missing_ids: set = set()
+        self.loaded_at: Optional[float] = None
+
+    def add(self, user: User):
+        self.by_id[user.id] = user
+        self.missing_ids.discard(user.id)
+        self.by_steam_username[user.steam_username] = user
+        if user.matrix_username:
+            self.by_matrix_username[user.matrix_username] = user
+
+    async def load(self):
+        """Replace the directory with the current contents of the users collection."""
+        users = await User.find().to_list()
+        self.by_id, self.by_steam_username, self.by_matrix_username = {}, {}, {}
+        self.missing_ids = set()
+        for user in users:
+            self.add(user)
+        self.loaded_at = time.monotonic()
+
+    async def refresh_if_stale(self):
+        if self.loaded_at is None or time.monotonic() - self.loaded_at > self.ttl_seconds:
+            await self.load()
+
+    def invalidate(self):
+        self.loaded_at = None
 
 
+user_directory = UserDirectory()
+
+
+@timed_service_call
+async def warm_user_cache():
+    """Load the user directory. Called at startup."""
+    await user_directory.load()
+
+
+@timed_service_call
 async def create_user(steam_username: str, **kwargs) -> User:
     """Create the user in the Mongo database.
     Any optional attributes should be in the kwargs.
@@ -9,40 +67,80 @@ async def create_user(steam_username: str, **kwargs) -> User:
                 matrix_username=kwargs.get("matrix_username"),
                 index_name=kwargs.get("index_name"))
     await user.save()
+    user_directory.add(user)
+    bump_data_version()
     return user
 
 
+@timed_service_call
+async def find_user(steam_username: str) -> Optional[User]:
+    """Return the user with this Steam username, if there is one."""
+    await user_directory.refresh_if_stale()
+    if user := user_directory.by_steam_username.get(steam_username):
+        return user
+    # not cached yet - make sure it wasn't added to the database some other way before we report it missing
+    if user := await User.find_one(User.steam_username == steam_username):
+        user_directory.add(user)
+    return user
+
+
+@timed_service_call
 async def get_matrix_name(steam_username: str) -> str:
     """Pass in a steam username and get a matrix username, if defined.
 
     Otherwise, return the Steam username.
     """
-    user = await User.find_one(User.steam_username == steam_username)
+    await user_directory.refresh_if_stale()
+    user = user_directory.by_steam_username.get(steam_username)
     if user and (matrix_username := user.matrix_username):
         return matrix_username
     else:
         return steam_username  # no matrix name found or user not in database
 
 
+@timed_service_call
 async def get_user(steam_username: str) -> User:
     """Return a user model."""
-    return await User.find_one(
-        User.steam_username == steam_username
-    ) or await create_user(steam_username)  # don't remember why I have it create one if it's not there
+    return await find_user(steam_username) or await create_user(
+        steam_username)  # don't remember why I have it create one if it's not there
 
 
+@timed_service_call
 async def get_user_id_from_matrix_username(matrix_username: str):
     """Return the user id as a string based on the matrix_username."""
-    user = await User.find_one(User.matrix_username == matrix_username)
+    await user_directory.refresh_if_stale()
+    if user := user_directory.by_matrix_username.get(matrix_username):
+        return user.id
+    # not cached yet - it may have been added by another process since the directory was loaded
+    if user := await User.find_one(User.matrix_username == matrix_username):
+        user_directory.add(user)
     return user.id if user else None
 
 
+@timed_service_call
 async def get_index_name_by_user_id(user_id) -> str:
     """Return the index name by user_id"""
-    user = await User.find_one(User.id == user_id)
-    return user.index_name
+    index_names = await get_index_names_by_user_ids([user_id])
+    return index_names.get(user_id)
+
+
+@timed_service_call
+async def get_index_names_by_user_ids(user_ids) -> dict:
+    """Return a dictionary of user_id to index name.
+
+    Users missing from the directory are looked up together in one query.
+    """
+    await user_directory.refresh_if_stale()
+    user_ids = set(user_ids)
+    if missing_ids := [user_id for user_id in user_ids
+                       if user_id not in user_directory.by_id and user_id not in user_directory.missing_ids]:
+        for user in await User.find(In(User.id, missing_ids)).to_list():
+            user_directory.add(user)
+        user_directory.missing_ids.update(user_id for user_id in missing_ids if user_id not in user_directory.by_id)
+    return {user_id: user.index_name for user_id in user_ids if (user := user_directory.by_id.get(user_id))}
 
 
+@timed_service_call
 async def get_all_index_names() -> list[str]:
-    users = await User.find().to_list()
-    return [user.index_name for user in users if user.index_name is not None]
+    await user_directory.refresh_if_stale()
+    return [user.index_name for user in user_directory.by_id.values() if user.index_name is not None]
@@ -3,28 +3,23 @@
 import asyncio
 import json
 import logging
-from datetime import datetime
+import time
+from datetime import datetime, timedelta
+from typing import Optional
 
-import requests
+import aiohttp
+from aiohttp import web
 from nio import AsyncClient
 
 from civ_vi_webhook.dependencies import figure_out_base_sixty, figure_out_days
 
 from ...models.db import mongo_setup
+from .. import metrics
 from ..db import matrix_service
 
 logging.basicConfig(level=logging.INFO, format='%(levelname)s - %(asctime)s - %(message)s')
 
 
-async def load_db():
-    with open("creds.conf", "r") as creds:
-        credentials = json.load(creds)
-    await mongo_setup.init_db('civ_vi_webhook',
-                              username=credentials.get("username"),
-                              password=credentials.get("password"),
-                              dev_server=credentials.get("development_server"))
-
-
 def return_time(time_difference) -> (int, int, int, int):
     """Return time in a useful manner."""
     days = time_difference.days
@@ -36,16 +31,52 @@ def return_time(time_difference) -> (int, int, int, int):
     return days, hours, minutes, seconds
 
 
+class APIResponse:
+    """The parts of a webhook API response the commands need."""
+
+    def __init__(self, status_code: int, body):
+        self.status_code = status_code
+        self.body = body
+
+    def json(self):
+        return self.body
+
+
 class ListenerMatrixBot:
-    """A bot to send alerts about the game to Matrix"""
+    """A bot to send alerts about the game to Matrix
+
+    Calls to the webhook API share one keep-alive HTTP session, so a command never blocks the sync loop.
+    Commands are queued per room: each room's commands are answered in order, different rooms are
+    answered in parallel, and at most max_concurrent_commands are worked on at once.
+
+    The sync token is saved before any commands from a sync are dispatched, so they are never run again after a
+    restart. Syncs without commands only save the token every checkpoint_interval seconds.
+
+    If metrics_port is set, the listener's sync and command timings are served at /metrics on that port.
+    """
 
     def __init__(self):
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.api_timeout = 10
+        self.max_concurrent_commands = 4
+        self.command_queues: dict[str, asyncio.Queue] = {}
+        self.room_workers: dict[str, asyncio.Task] = {}
+        self._command_slots: Optional[asyncio.Semaphore] = None
+        self.checkpoint_interval = 300
+        self.unsaved_next_batch: Optional[str] = None
+        self.last_checkpoint_at = time.monotonic()
+        self.metrics_port: Optional[int] = None
         try:
             with open('matrix.conf') as file:
                 self.config = json.load(file)
                 logging.debug("Listener Matrix Config loaded.")
                 file.close()
                 self.url = self.config.get('webhook_url')
+                self.api_timeout = self.config.get('api_timeout', self.api_timeout)
+                self.max_concurrent_commands = self.config.get('max_concurrent_commands',
+                                                               self.max_concurrent_commands)
+                self.checkpoint_interval = self.config.get('checkpoint_interval', self.checkpoint_interval)
+                self.metrics_port = self.config.get('metrics_port')
         except FileNotFoundError:
             logging.warning("Settings not found.")
 
@@ -56,16 +87,41 @@ class ListenerMatrixBot:
         logging.debug(f"Listener Room would be: {self.config.get('room')}")
         return client
 
-    def get_current_games(self, player_to_blame: str = ""):
+    def open_session(self) -> aiohttp.ClientSession:
+        """Create the HTTP session used for every call to the webhook API."""
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.api_timeout))
+        return self.session
+
+    async def close_session(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def call_api(self, method: str, endpoint: str, params: Optional[dict] = None) -> Optional[APIResponse]:
+        """Make a request to the webhook API.
+
+        :returns: The response, or None if the API could not be reached in time.
+        """
+        try:
+            async with self.open_session().request(method, f"{self.url}/{endpoint}", params=params) as response:
+                body = await response.json(content_type=None) if response.status == 200 else None
+                return APIResponse(response.status, body)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+            logging.error(f"Listener could not reach {endpoint}: {error!r}")
+            return None
+
+    async def get_current_games(self, player_to_blame: str = ""):
         """Get the list of games from the recent games endpoint.
 
         :returns: A dictionary of the games, next player, and turn number.
         """
-        response = requests.get(f"{self.url}/current_games",
-                                params={'player_to_blame': player_to_blame}) if player_to_blame else requests.get(
-            f"{self.url}/current_games")
+        response = await self.call_api("GET", "current_games",
+                                       params={'player_to_blame': player_to_blame} if player_to_blame else None)
 
-        if response.status_code == 200:
+        if response is None:
+            return None
+        elif response.status_code == 200:
             return response.json()
         elif response.status_code == 404:
             return {}
@@ -90,10 +146,10 @@ class ListenerMatrixBot:
             return_text += '\n'
         return return_text
 
-    def format_current_games(self):
+    async def format_current_games(self):
         """Format the list of current games for display in Matrix server."""
         return_text = "Here is a list of the games currently known about on the server:\n"
-        if response_json := self.get_current_games():
+        if response_json := await self.get_current_games():
             response = response_json
             games = response['games']
             logging.debug(f"{games=}")
@@ -103,17 +159,33 @@ class ListenerMatrixBot:
             return_text = "There are no games available on the server. Or an error occurred."
         return return_text
 
-    def format_blame_games(self, player_name: str) -> str:
+    @staticmethod
+    def format_blame_text(blame_summary: dict) -> str:
+        """Format the games from the blame summary, which come with their wait times already worked out."""
+        return_text = ""
+        player = blame_summary.get('player_name') or blame_summary['player_to_blame']
+        for game in blame_summary['games']:
+            return_text += f"{game['game_name']} awaiting turn {game['turn_number']} by {player}. "
+            if game.get('wait_seconds') is not None:
+                days, hours, minutes, seconds = return_time(timedelta(seconds=round(game['wait_seconds'])))
+                return_text += f"It's been {days} days {hours} hours {minutes} minutes {seconds} seconds since the " \
+                               f"last turn. "
+            return_text += '\n'
+        return return_text
+
+    async def format_blame_games(self, player_name: str) -> str:
         number_of_games = 0
         return_text = ""
-        response = requests.get(f"{self.url}/total_number_of_games")
-        total_number_of_current_games = response.json().get('current_games')
-        if response_json := self.get_current_games(player_name):
-            response = response_json
-            games = response['games']
-            return_text += self.format_response_text(games)
+        total_number_of_current_games = 0
+        response = await self.call_api("GET", "blame_summary", params={'player_to_blame': player_name})
+        if response is None:
+            return "Sorry, I couldn't get the games from the server."
+        elif response.status_code == 200:
+            blame_summary = response.json()
+            return_text += self.format_blame_text(blame_summary)
             logging.debug(return_text)
-            number_of_games = len(games)
+            number_of_games = len(blame_summary['games'])
+            total_number_of_current_games = blame_summary['total_current_games']
         if 0 < number_of_games < 2:
             return f"There is {number_of_games} game out of {total_number_of_current_games} waiting for {player_name} " \
                    f"to take their turn:\n" + return_text
@@ -127,7 +199,7 @@ class ListenerMatrixBot:
         else:
             return f"There aren't any games waiting for {player_name}. Great job!"
 
-    def delete_game(self, game_to_delete: str) -> str:
+    async def delete_game(self, game_to_delete: str) -> str:
         """Delete the game requested by the user.
 
         If that isn't a game, let the user know.
@@ -135,14 +207,16 @@ class ListenerMatrixBot:
         :param game_to_delete: The Game to delete.
         :returns: A string letting the user know the success or failure of the deletion.
         """
-        response = requests.delete(f"{self.url}/delete_game", params={'game_to_delete': game_to_delete})
-        if response.status_code == 200:
+        response = await self.call_api("DELETE", "delete_game", params={'game_to_delete': game_to_delete})
+        if response is None:
+            return "Sorry, I couldn't reach the server. Try again in a bit."
+        elif response.status_code == 200:
             game_info = response.json()
             return f"Deleted {game_info['deleted_game']}"
         elif response.status_code == 404:
             return f"{game_to_delete} was not in the system."
 
-    def complete_game(self, game_to_complete: str) -> str:
+    async def complete_game(self, game_to_complete: str) -> str:
         """Mark the game as completed in the database.
 
         If the game doesn't exist, let the user know.
@@ -150,15 +224,17 @@ class ListenerMatrixBot:
         :param game_to_complete: The game to mark as completed
         :returns: A string to let the user know if it succeeded or not.
         """
-        response = requests.put(f"{self.url}/complete_game", params={'game_to_complete': game_to_complete})
-        if response.status_code == 200:
+        response = await self.call_api("PUT", "complete_game", params={'game_to_complete': game_to_complete})
+        if response is None:
+            return "Sorry, I couldn't reach the server. Try again in a bit."
+        elif response.status_code == 200:
             completion_status = response.json()
             logging.debug(f"{completion_status=}")
             return f"Marked {completion_status['completed_game']['game_name']} as completed."
         elif response.status_code == 404:
             return f"{game_to_complete} was not found. Did you spell it correctly?"
 
-    def decipher_commands(self, command: str) -> str:
+    async def decipher_commands(self, command: str) -> str:
         """Decide what the bot is being asked to do.
 
         :param command: A string containing a command for Civ_Bot.
@@ -174,36 +250,105 @@ class ListenerMatrixBot:
                       """
 
         elif command == "current games":
-            return self.format_current_games()
+            return await self.format_current_games()
         elif command.startswith("blame"):
             player_to_blame = command.lstrip("blame ")
-            return self.format_blame_games(player_to_blame)
+            return await self.format_blame_games(player_to_blame)
         elif command.startswith("delete"):
             game = command.lstrip("delete ")
-            return self.delete_game(game)
+            return await self.delete_game(game)
         elif command.startswith("complete"):
             game = command.lstrip("complete ")
-            return self.complete_game(game)
+            return await self.complete_game(game)
         else:
             return "Sorry, I didn't recognize that command. Try !Civ_Bot help to see command list."
 
+    async def checkpoint(self, next_batch: str, force: bool = False):
+        """Save the sync token if forced or the checkpoint interval has passed, otherwise hold on to it."""
+        self.unsaved_next_batch = next_batch
+        if force or time.monotonic() - self.last_checkpoint_at >= self.checkpoint_interval:
+            await self.flush_checkpoint()
+
+    async def flush_checkpoint(self):
+        if self.unsaved_next_batch is not None:
+            await matrix_service.write_next_batch(self.unsaved_next_batch)
+            self.unsaved_next_batch = None
+        self.last_checkpoint_at = time.monotonic()
+
+    def dispatch_command(self, client: AsyncClient, room_id: str, event):
+        """Queue a command to be answered by the room's worker, starting the worker if it isn't running."""
+        if self._command_slots is None:
+            self._command_slots = asyncio.Semaphore(self.max_concurrent_commands)
+        queue = self.command_queues.setdefault(room_id, asyncio.Queue())
+        queue.put_nowait((event, time.monotonic()))
+        if room_id not in self.room_workers:
+            self.room_workers[room_id] = asyncio.create_task(self._answer_room_commands(client, room_id))
+
+    async def _answer_room_commands(self, client: AsyncClient, room_id: str):
+        """Answer a room's queued commands in order, exiting once the queue is empty."""
+        queue = self.command_queues[room_id]
+        while not queue.empty():
+            event, received_at = queue.get_nowait()
+            try:
+                async with self._command_slots:
+                    data_to_send = await self.decipher_commands(event.body.lstrip("!Civ_Bot "))
+                    logging.debug(data_to_send)
+                    content = {"body": data_to_send, "msgtype": "m.text"}
+                    await client.room_send(room_id, 'm.room.message', content)
+                metrics.listener_command_seconds.observe(time.monotonic() - received_at)
+                since_sent = time.time() - event.server_timestamp / 1000 if event.server_timestamp else None
+                logging.info(f"Answered '{event.body}' in {room_id} in {time.monotonic() - received_at:.3f}s"
+                             f"{f' ({since_sent:.3f}s after it was sent)' if since_sent is not None else ''}.")
+            except Exception as error:  # one bad command shouldn't stop the room's queue
+                logging.error(f"Could not answer '{event.body}' in {room_id}: {error!r}")
+        del self.room_workers[room_id]
+
+    async def stop_room_workers(self):
+        for worker in self.room_workers.values():
+            worker.cancel()
+        await asyncio.gather(*self.room_workers.values(), return_exceptions=True)
+        self.room_workers.clear()
+
+    async def start_metrics_server(self) -> Optional[web.AppRunner]:
+        """Serve the listener's metrics on localhost, if a metrics_port is set."""
+        if not self.metrics_port:
+            return None
+
+        async def serve_metrics(_request):
+            return web.Response(text=metrics.registry.render(), content_type="text/plain")
+        metrics_app = web.Application()
+        metrics_app.router.add_get("/metrics", serve_metrics)
+        runner = web.AppRunner(metrics_app)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", self.metrics_port).start()
+        return runner
+
     async def main(self):
-        await load_db()
+        await mongo_setup.init_db_from_credentials()
         my_client = await self.login()
         my_client.next_batch = await matrix_service.get_next_batch()
-        while True:
-            sync_response = await my_client.sync(30000)
-            await matrix_service.write_next_batch(sync_response.next_batch)
-            if len(sync_response.rooms.join) > 0:
-                joins = sync_response.rooms.join
-                for room_id in joins:
-                    for event in joins[room_id].timeline.events:
-                        if hasattr(event, 'body') and event.body.startswith("!Civ_Bot"):
-                            data_to_send = self.decipher_commands(event.body.lstrip("!Civ_Bot "))
-                            logging.debug(data_to_send)
-                            content = {"body": data_to_send, "msgtype": "m.text"}
-                            await my_client.room_send(room_id, 'm.room.message', content)
-
-
-my_matrix_bot = ListenerMatrixBot()
-asyncio.run(my_matrix_bot.main())
+        self.open_session()
+        metrics_server = await self.start_metrics_server()
+        try:
+            while True:
+                sync_started = time.perf_counter()
+                sync_response = await my_client.sync(30000)
+                metrics.listener_sync_seconds.observe(time.perf_counter() - sync_started)
+                commands = [(room_id, event) for room_id, room in sync_response.rooms.join.items()
+                            for event in room.timeline.events
+                            if hasattr(event, 'body') and event.body.startswith("!Civ_Bot")]
+                await self.checkpoint(sync_response.next_batch, force=bool(commands))
+                for room_id, event in commands:
+                    self.dispatch_command(my_client, room_id, event)
+        finally:
+            await self.stop_room_workers()
+            await self.flush_checkpoint()
+            await self.close_session()
+            await my_client.close()
+            if metrics_server is not None:
+                await metrics_server.cleanup()
+
+
+if __name__ == "__main__":
+    my_matrix_bot = ListenerMatrixBot()
+    asyncio.run(my_matrix_bot.main())
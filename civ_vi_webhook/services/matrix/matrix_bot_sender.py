@@ -3,15 +3,26 @@
 import asyncio
 import json
 import logging
+import time
+from typing import Optional
 
-from nio import AsyncClient
+from nio import AsyncClient, LoginResponse, RoomSendError
+
+from civ_vi_webhook.services import metrics, tracing
 
 logging.basicConfig(level=logging.INFO, format='%(levelname)s - %(asctime)s - %(message)s')
 
 
 class MatrixBot:
-    """A bot to send alerts about the game to Matrix"""
+    """A bot to send alerts about the game to Matrix
+
+    The bot keeps a single logged-in client (and its HTTP connection pool) for as long as the app runs.
+    It only logs in again if the homeserver rejects the access token.
+    """
     def __init__(self):
+        self.client: Optional[AsyncClient] = None
+        self._login_lock: Optional[asyncio.Lock] = None
+        self.config: dict = {}
         try:
             with open('matrix.conf') as file:
                 self.config = json.load(file)
@@ -20,18 +31,56 @@ class MatrixBot:
         except FileNotFoundError:
             logging.warning("Settings not found.")
 
+    async def login(self) -> AsyncClient:
+        """Log in to the homeserver, creating the client the first time through."""
+        if self._login_lock is None:
+            self._login_lock = asyncio.Lock()
+        async with self._login_lock:
+            if self.client is None:
+                self.client = AsyncClient(self.config.get('server'), self.config.get('username'))
+            elif self.client.access_token:
+                return self.client  # another coroutine logged in while we waited on the lock
+            response = await self.client.login(password=self.config.get("password"))
+            logging.info(f"Alert Matrix Bot Login response: {response}")
+            if not isinstance(response, LoginResponse):
+                logging.error(f"Alert Matrix Bot could not log in: {response}")
+            logging.debug(f"Alert Matrix Bot has joined room would be: {self.config.get('room')}")
+            return self.client
+
+    async def _room_send(self, client: AsyncClient, message: str):
+        return await client.room_send(room_id=self.config.get('room'), message_type="m.room.message",
+                                      content={"msgtype": "m.text", "body": message})
+
     async def send_message(self, message: str):
-        client = AsyncClient(self.config.get('server'), self.config.get('username'))
-        response = await client.login(password=self.config.get("password"))
-        logging.info(f"Alert Matrix Bot Login response: {response}")
-        logging.debug(f"Alert Matrix Bot has joined room would be: {self.config.get('room')}")
-        msg_response = await client.room_send(room_id=self.config.get('room'), message_type="m.room.message",
-                                              content={"msgtype": "m.text", "body": message})
+        started = time.perf_counter()
+        try:
+            client = self.client if self.client and self.client.access_token else await self.login()
+            msg_response = await self._room_send(client, message)
+            if isinstance(msg_response, RoomSendError) and msg_response.status_code == "M_UNKNOWN_TOKEN":
+                logging.info("Alert Matrix Bot access token was rejected, logging in again.")
+                client.access_token = ""
+                client = await self.login()
+                msg_response = await self._room_send(client, message)
+        finally:
+            duration = time.perf_counter() - started
+            metrics.matrix_send_seconds.observe(duration)
+            tracing.record_span("matrix.send", started, duration)
         logging.debug(f"Message Response: {msg_response}")
-        await client.close()
+        return msg_response
+
+    async def close(self):
+        """Close the client and its connection pool. Called when the app shuts down."""
+        if self.client is not None:
+            await self.client.close()
+            self.client = None
+            logging.debug("Alert Matrix Bot client closed.")
+
+    async def _send_and_close(self, message: str):
+        await self.send_message(message)
+        await self.close()
 
     def main(self, message):
-        asyncio.run(self.send_message(message))
+        asyncio.run(self._send_and_close(message))
 
 
 if __name__ == "__main__":
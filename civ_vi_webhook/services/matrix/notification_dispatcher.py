@@ -0,0 +1,151 @@
+"""Deliver the notifications waiting in the outbox to Matrix."""
+
+import asyncio
+import contextlib
+import time
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Optional
+
+from nio import ErrorResponse
+
+from civ_vi_webhook import api_logger
+from civ_vi_webhook.models.db.notifications import Notification
+
+from .. import metrics
+from ..db import notification_service
+from .matrix_bot_sender import MatrixBot
+
+
+def build_digest(notifications: list[Notification]) -> str:
+    """Merge one recipient's notifications into a single message, dropping repeats.
+
+    A repeat is the same message, or another notification for the same game and turn (eg from both PBC and PYDT).
+    Turns are summed up as a list of games. Notifications that aren't about a game keep their own message.
+    """
+    turns, others = [], []
+    seen = set()
+    for notification in notifications:
+        turn = (notification.game_name, notification.turn_number) if notification.game_name else None
+        if notification.message in seen or turn in seen:
+            continue
+        seen.add(notification.message)
+        if turn is None:
+            others.append(notification.message)
+        else:
+            seen.add(turn)
+            turns.append(notification)
+    if len(turns) > 1:
+        games = ", ".join(f"{notification.game_name} (turn {notification.turn_number})" for notification in turns)
+        lines = [f"Hey, {turns[0].recipient}, it's your turn in {len(turns)} games: {games}"]
+    else:
+        lines = [notification.message for notification in turns]
+    return "\n".join(lines + others)
+
+
+class NotificationDispatcher:
+    """A background task that sends queued notifications, retrying failures with exponential backoff.
+
+    Notifications with a recipient are held for coalesce_window seconds so that a burst of turns for one player
+    goes out as one digest message. Messages to the room are at least min_send_interval seconds apart.
+    """
+
+    def __init__(self, matrix_bot: MatrixBot, poll_interval: float = 5.0, base_retry_delay: float = 2.0,
+                 max_retry_delay: float = 600.0, max_attempts: int = 12, coalesce_window: float = 10.0,
+                 min_send_interval: float = 1.0):
+        self.matrix_bot = matrix_bot
+        self.poll_interval = poll_interval
+        self.coalesce_window = coalesce_window
+        self.min_send_interval = min_send_interval
+        self._last_sent_at: Optional[float] = None
+        self.base_retry_delay = base_retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.max_attempts = max_attempts
+        self.delivered_count = 0
+        self.failed_attempt_count = 0
+        self.recent_latencies: deque = deque(maxlen=100)
+        self._task: Optional[asyncio.Task] = None
+        self._wake_up: Optional[asyncio.Event] = None
+
+    def start(self):
+        self._wake_up = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+    def wake(self, after: float = 0):
+        """Let the dispatcher know there is something new in the outbox, due in `after` seconds."""
+        if self._wake_up is None:
+            return
+        if after:
+            asyncio.get_running_loop().call_later(after, self._wake_up.set)
+        else:
+            self._wake_up.set()
+
+    def retry_delay(self, attempts: int) -> timedelta:
+        """How long to wait before the next attempt after `attempts` failures."""
+        return timedelta(seconds=min(self.base_retry_delay * 2 ** (attempts - 1), self.max_retry_delay))
+
+    async def _run(self):
+        requeued = await notification_service.requeue_interrupted_notifications()
+        if requeued:
+            api_logger.info(f"Requeued {requeued} notifications interrupted by the last shutdown.")
+        while True:
+            try:
+                await self.deliver_due_notifications()
+            except Exception as error:  # keep dispatching even if the database hiccups
+                api_logger.error(f"Notification dispatcher error: {error!r}")
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._wake_up.wait(), timeout=self.poll_interval)
+            self._wake_up.clear()
+
+    async def _wait_for_send_slot(self):
+        if self._last_sent_at is not None:
+            wait = self.min_send_interval - (time.monotonic() - self._last_sent_at)
+            if wait > 0:
+                await asyncio.sleep(wait)
+        self._last_sent_at = time.monotonic()
+
+    async def deliver_due_notifications(self):
+        while notification := await notification_service.claim_next_notification(datetime.now()):
+            notifications = [notification]
+            if notification.recipient:
+                notifications += await notification_service.claim_pending_for_recipient(notification.recipient)
+            await self._wait_for_send_slot()
+            try:
+                response = await self.matrix_bot.send_message(build_digest(notifications))
+                error = str(response) if isinstance(response, ErrorResponse) else None
+            except Exception as exception:
+                error = repr(exception)
+            if error is None:
+                delivered_at = datetime.now()
+                await notification_service.mark_delivered(notifications, delivered_at)
+                metrics.notifications.inc("delivered", amount=len(notifications))
+                for delivered in notifications:
+                    self.delivered_count += 1
+                    self.recent_latencies.append((delivered_at - delivered.created_at).total_seconds())
+                latency = (delivered_at - notification.created_at).total_seconds()
+                api_logger.debug(f"Delivered {len(notifications)} notification(s) starting with {notification.id} "
+                                 f"after {latency:.3f}s.")
+            else:
+                self.failed_attempt_count += len(notifications)
+                metrics.notifications.inc("failed_attempt", amount=len(notifications))
+                # a digest can include notifications that have already been tried more often than the first
+                attempts = max(claimed.attempts for claimed in notifications)
+                retry_in = self.retry_delay(attempts) if attempts < self.max_attempts else None
+                if retry_in is None:
+                    metrics.notifications.inc("gave_up", amount=len(notifications))
+                api_logger.warning(f"Notification {notification.id} attempt {attempts} failed: {error}. "
+                                   f"{f'Retrying in {retry_in}.' if retry_in else 'Giving up.'}")
+                await notification_service.mark_failed(notifications, error, retry_in)
+
+
+matrix_bot = MatrixBot()
+notification_dispatcher = NotificationDispatcher(matrix_bot,
+                                                 coalesce_window=matrix_bot.config.get("coalesce_window", 10),
+                                                 min_send_interval=matrix_bot.config.get("min_send_interval", 1))
@@ -0,0 +1,151 @@
+"""Counters and latency histograms, served in the Prometheus text format at /metrics.
+
+Each observation is a dict lookup and a couple of additions, so the metrics can sit on every request and database
+call. They live in this process: the server and the Matrix listener each serve their own.
+"""
+import functools
+import time
+from bisect import bisect_left
+from typing import Optional
+
+from . import tracing
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(label_value) -> str:
+    return str(label_value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(label_names: tuple, label_values: tuple, extra: str = "") -> str:
+    labels = [f'{name}="{_escape(value)}"' for name, value in zip(label_names, label_values)]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+class Counter:
+    """A count for each combination of label values."""
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, label_names: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, *label_values, amount: float = 1):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values) -> float:
+        return self._values.get(label_values, 0)
+
+    def samples(self) -> list[str]:
+        return [f"{self.name}{_format_labels(self.label_names, label_values)} {value}"
+                for label_values, value in self._values.items()]
+
+
+class Histogram:
+    """How many observations fell in each bucket, plus their sum, for each combination of label values.
+
+    The bucket counts are kept per bucket and only added up when rendered, so an observation touches one slot.
+    """
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, label_names: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.buckets = buckets
+        self._series: dict[tuple, list] = {}  # label values -> [bucket counts (the last is +Inf), sum]
+
+    def observe(self, value: float, *label_values):
+        series = self._series.get(label_values)
+        if series is None:
+            series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def count(self, *label_values) -> int:
+        series = self._series.get(label_values)
+        return sum(series[0]) if series else 0
+
+    def samples(self) -> list[str]:
+        lines = []
+        for label_values, (bucket_counts, total) in self._series.items():
+            cumulative = 0
+            for upper_bound, bucket_count in zip(self.buckets + ("+Inf",), bucket_counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.label_names, label_values, f'le="{upper_bound}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.label_names, label_values)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: list = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+http_requests = registry.register(Counter(
+    "civ_vi_webhook_http_requests_total", "Requests handled, by route and status code.",
+    ("method", "route", "status")))
+http_request_seconds = registry.register(Histogram(
+    "civ_vi_webhook_http_request_seconds", "Time to handle a request, up to the start of the response.",
+    ("method", "route")))
+service_call_seconds = registry.register(Histogram(
+    "civ_vi_webhook_service_call_seconds", "Time spent in each game_service and user_service function.",
+    ("function",)))
+matrix_send_seconds = registry.register(Histogram(
+    "civ_vi_webhook_matrix_send_seconds", "Time to send a message to the Matrix room."))
+notifications = registry.register(Counter(
+    "civ_vi_webhook_notifications_total",
+    "Notifications delivered, failed to send (once per failed attempt) and given up on.",
+    ("outcome",)))
+listener_sync_seconds = registry.register(Histogram(
+    "civ_vi_webhook_listener_sync_seconds", "Time the listener's sync with the homeserver took, long poll included.",
+    buckets=(0.1, 0.5, 1.0, 5.0, 10.0, 20.0, 30.0, 35.0, 60.0)))
+listener_command_seconds = registry.register(Histogram(
+    "civ_vi_webhook_listener_command_seconds", "Time from the listener seeing a command to answering it."))
+
+
+def observe_request(method: str, route: Optional[str], status_code: int, seconds: float):
+    route = route or "unmatched"  # paths that matched no route are lumped together to keep the label set small
+    http_requests.inc(method, route, status_code)
+    http_request_seconds.observe(seconds, method, route)
+
+
+def timed_service_call(function):
+    """Record how long each call of a service function takes, labelled eg game_service.record_turn.
+
+    The call is also a span of the request's trace, if it is being traced. It is for the functions requests
+    call; one-off migrations are left untimed so they don't add series nobody will look at again.
+    """
+    label = f"{function.__module__.rsplit('.', 1)[-1]}.{function.__qualname__}"
+
+    @functools.wraps(function)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await function(*args, **kwargs)
+        finally:
+            duration = time.perf_counter() - started
+            service_call_seconds.observe(duration, label)
+            tracing.record_span(label, started, duration)
+    return wrapper
@@ -0,0 +1,51 @@
+"""Cache rendered responses until the game data changes.
+
+Every write to the games or users bumps the data version, which empties the cache. The version lives in this
+process, so run a single server process (as in the README) or each process will only see its own writes.
+"""
+import hashlib
+import uuid
+from collections import OrderedDict
+from typing import Any, Optional
+
+
+class VersionedCache:
+    """A bounded cache of rendered responses, valid for one version of the game data."""
+
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        self.version = 0
+        self.instance = uuid.uuid4().hex[:8]  # so an ETag from before a restart never matches
+        self._entries: OrderedDict[str, Any] = OrderedDict()
+
+    def bump(self):
+        """The game data changed, so everything cached is out of date."""
+        self.version += 1
+        self._entries.clear()
+
+    def etag(self, key: str) -> str:
+        """A strong ETag for the response stored under key at the current version."""
+        key_hash = hashlib.sha1(key.encode()).hexdigest()[:12]
+        return f'"{self.instance}-{self.version}-{key_hash}"'
+
+    def get(self, key: str) -> Optional[Any]:
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return self._entries[key]
+        return None
+
+    def put(self, key: str, value: Any, version: int):
+        """Store a value that was built from the data at `version`. It is dropped if the data has changed since."""
+        if version != self.version:
+            return
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+
+response_cache = VersionedCache()
+
+
+def bump_data_version():
+    response_cache.bump()
@@ -0,0 +1,193 @@
+"""Opt-in breakdown of where a request's time went.
+
+A request is traced at random for trace_sample_rate of requests, or when it has an X-Trace header if
+allow_trace_header is on (both from creds.conf, and off unless set, since anyone can send the header). While it
+runs, service calls, Mongo round trips, template renders and Matrix sends add spans to the trace in a ContextVar.
+The totals go back in a Server-Timing header, and the whole trace is kept for /traces.
+Untraced requests only pay for the ContextVar lookup.
+
+With X-Trace: profile the request is also run under cProfile. That is a deterministic profiler, not a sampling one:
+every Python call is instrumented, which can make the request several times slower. It sees the whole event loop,
+so anything else the server does meanwhile shows up in the profile too, and only one request is profiled at a time.
+Sampled traces are never profiled, so profiling only happens when allow_trace_header is on and the header asks.
+"""
+import contextvars
+import cProfile
+import io
+import pstats
+import random
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+from typing import Optional
+
+from pymongo import monitoring
+
+TRACE_HEADER = "X-Trace"
+
+# set from creds.conf when the server starts
+sample_rate = 0.0
+allow_trace_header = False  # also serves the traces at /traces
+
+
+def configure(trace_sample_rate=0.0, allow_header: bool = False):
+    """Set how requests are picked for tracing.
+
+    :raises ValueError: If trace_sample_rate isn't a number from 0 to 1.
+    """
+    global sample_rate, allow_trace_header
+    is_number = isinstance(trace_sample_rate, (int, float)) and not isinstance(trace_sample_rate, bool)
+    if not is_number or not 0 <= trace_sample_rate <= 1:
+        raise ValueError(f"trace_sample_rate should be a number from 0 to 1, not {trace_sample_rate!r}")
+    sample_rate = float(trace_sample_rate)
+    allow_trace_header = bool(allow_header)
+
+
+class Trace:
+    """The spans recorded during one request, with their start relative to the start of the request."""
+
+    def __init__(self, method: str, path: str):
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.method = method
+        self.path = path
+        self.started_at = datetime.now()
+        self.started = time.perf_counter()
+        self.total_seconds: Optional[float] = None
+        self.spans: list[tuple[str, float, float]] = []
+        self.profile: Optional[str] = None
+
+    def add_span(self, name: str, started: float, duration: float):
+        self.spans.append((name, started - self.started, duration))
+
+    def finish(self):
+        self.total_seconds = time.perf_counter() - self.started
+
+    def server_timing(self) -> str:
+        """The header value: the total, then each kind of span with its summed duration and how many there were."""
+        durations: dict[str, list] = {}
+        for name, _start, duration in self.spans:
+            totals = durations.setdefault(name, [0.0, 0])
+            totals[0] += duration
+            totals[1] += 1
+        metrics = [f"total;dur={self.total_seconds * 1000:.2f}"]
+        metrics += [f'{name};dur={duration * 1000:.2f};desc="{count}x"'
+                    for name, (duration, count) in durations.items()]
+        return ", ".join(metrics)
+
+    def as_dict(self) -> dict:
+        return {"trace_id": self.trace_id, "method": self.method, "path": self.path,
+                "started_at": self.started_at.isoformat(), "total_seconds": self.total_seconds,
+                "spans": [{"name": name, "start_seconds": start, "duration_seconds": duration}
+                          for name, start, duration in self.spans],
+                "profile": self.profile}
+
+
+current_trace: contextvars.ContextVar[Optional[Trace]] = contextvars.ContextVar("current_trace", default=None)
+
+
+class RecentTraces:
+    """The last few finished traces, for /traces."""
+
+    def __init__(self, max_entries: int = 50):
+        self.max_entries = max_entries
+        self._traces: OrderedDict[str, Trace] = OrderedDict()
+
+    def add(self, trace: Trace):
+        self._traces[trace.trace_id] = trace
+        while len(self._traces) > self.max_entries:
+            self._traces.popitem(last=False)
+
+    def get(self, trace_id: str) -> Optional[Trace]:
+        return self._traces.get(trace_id)
+
+    def all(self) -> list[Trace]:
+        return list(reversed(self._traces.values()))
+
+
+recent_traces = RecentTraces()
+
+
+def wants_trace(header_value: Optional[str]) -> bool:
+    return (allow_trace_header and header_value is not None) or (sample_rate > 0 and random.random() < sample_rate)
+
+
+def wants_profile(header_value: Optional[str]) -> bool:
+    return allow_trace_header and header_value == "profile"
+
+
+def record_span(name: str, started: float, duration: float):
+    """Add a span to the current request's trace, if it is being traced."""
+    trace = current_trace.get()
+    if trace is not None:
+        trace.add_span(name, started, duration)
+
+
+class span:
+    """Time the block as a span of the current trace: with tracing.span("render index.html"): ..."""
+    __slots__ = ("name", "started")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.started = None
+
+    def __enter__(self):
+        if current_trace.get() is not None:
+            self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *_exc_info):
+        if self.started is not None:
+            record_span(self.name, self.started, time.perf_counter() - self.started)
+
+
+class MongoCommandSpans(monitoring.CommandListener):
+    """Adds a span for each Mongo round trip. Motor runs pymongo in threads but copies the ContextVars across.
+
+    The server passes one to mongo_setup.init_db.
+    """
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self._record(event)
+
+    def failed(self, event):
+        self._record(event)
+
+    @staticmethod
+    def _record(event):
+        duration = event.duration_micros / 1_000_000
+        record_span(f"mongo.{event.command_name}", time.perf_counter() - duration, duration)
+
+
+class RequestProfile:
+    """cProfile for one request at a time, keeping the functions that took the most time.
+
+    cProfile instruments every call rather than sampling, so this is only for a request that asked with
+    X-Trace: profile, which is ignored unless allow_trace_header is on.
+    """
+    active = False
+
+    def __init__(self):
+        self.profiler: Optional[cProfile.Profile] = None
+
+    def __enter__(self):
+        if not RequestProfile.active:
+            RequestProfile.active = True
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        return self
+
+    def __exit__(self, *_exc_info):
+        if self.profiler is not None:
+            self.profiler.disable()
+            RequestProfile.active = False
+
+    def report(self, top: int = 30) -> Optional[str]:
+        if self.profiler is None:
+            return None
+        output = io.StringIO()
+        pstats.Stats(self.profiler, stream=output).sort_stats("cumulative").print_stats(top)
+        return output.getvalue()
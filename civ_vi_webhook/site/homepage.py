@@ -4,8 +4,10 @@ import fastapi.responses
 from fastapi import APIRouter
 from starlette.requests import Request
 
-from ..dependencies import templates
+from ..dependencies import get_average_turn_time, templates
+from ..services import tracing
 from ..services.db import game_service, user_service
+from ..services.response_cache import response_cache
 
 router = APIRouter(tags=['index'], include_in_schema=False)
 
@@ -17,14 +19,14 @@ async def get_potential_winners_list() -> list:
     return winners
 
 
-async def db_models_to_dictionary(games) -> list[dict]:
+def db_models_to_dictionary(games, player_names: dict) -> list[dict]:
     """Convert a game from a DB Model to a dictionary for use by Jinja2"""
     games_to_return = []
     for game in games:
         time_stamp = game.game_info.time_stamp_v2.strftime('%m-%d-%Y %H:%M:%S')
-        player_name = await user_service.get_index_name_by_user_id(game.game_info.next_player_id)
+        player_name = player_names.get(game.game_info.next_player_id)
         this_game = {"game_name": game.game_name, "player_name": player_name,
-                     "average_turn_time": game.game_info.average_turn_time,
+                     "average_turn_time": get_average_turn_time(game),
                      "winner": game.game_info.winner,
                      "turn_number": game.game_info.turn_number,
                      "time_stamp": time_stamp}
@@ -32,30 +34,55 @@ async def db_models_to_dictionary(games) -> list[dict]:
     return games_to_return
 
 
-async def get_games_for_index() -> (list, list):
-    """Get the completed and current games into a list for the Jinja2 templates."""
-    current_games_raw = await game_service.get_current_games()
-    if current_games_raw:
-        current_games = await db_models_to_dictionary(current_games_raw)
-    else:
-        current_games = []
+async def get_current_games_for_template() -> list:
+    """Get the current games into a list for the Jinja2 templates."""
+    current_games_raw = await game_service.get_current_games() or []
+    player_names = await user_service.get_index_names_by_user_ids(game.game_info.next_player_id for game
+                                                                  in current_games_raw)
+    return db_models_to_dictionary(current_games_raw, player_names)
+
+
+async def get_completed_games_for_template() -> list:
+    """Get the completed games into a list for the Jinja2 templates."""
     completed_games_raw = await game_service.get_completed_games()
-    if completed_games_raw:
-        completed_games = await db_models_to_dictionary(completed_games_raw)
-    else:
-        completed_games = []
-    return completed_games, current_games
+    player_names = await user_service.get_index_names_by_user_ids(game.game_info.next_player_id for game
+                                                                  in completed_games_raw)
+    return db_models_to_dictionary(completed_games_raw, player_names)
+
+
+async def get_both_tables_context() -> dict:
+    """Everything the index page and both_tables partial render."""
+    return {"current_games": await get_current_games_for_template(),
+            "completed_games": await get_completed_games_for_template(),
+            "potential_winners": await get_potential_winners_list()}
+
+
+async def get_completed_table_context() -> dict:
+    return {"completed_games": await get_completed_games_for_template(),
+            "potential_winners": await get_potential_winners_list()}
+
+
+async def get_current_table_context() -> dict:
+    return {"current_games": await get_current_games_for_template()}
+
+
+async def render_cached_template(template_name: str, get_context) -> fastapi.responses.HTMLResponse:
+    """Render the template, or reuse the last rendering if the game data hasn't changed since."""
+    cache_key = f"template:{template_name}"
+    html = response_cache.get(cache_key)
+    if html is None:
+        version = response_cache.version
+        context = await get_context()
+        with tracing.span(f"render.{template_name}"):
+            html = templates.get_template(template_name).render(context)
+        response_cache.put(cache_key, html, version)
+    return fastapi.responses.HTMLResponse(html)
 
 
 @router.get('/')
 async def index(request: Request):
     """Render the index page."""
-    completed_games, current_games = await get_games_for_index()
-    potential_winners = await get_potential_winners_list()
-    return templates.TemplateResponse('index.html', {'request': request,
-                                                     "current_games": current_games,
-                                                     "completed_games": completed_games,
-                                                     "potential_winners": potential_winners})
+    return await render_cached_template('index.html', get_both_tables_context)
 
 
 @router.get('/favicon.ico')
@@ -75,12 +102,7 @@ async def get_both_games_tables(request: Request, game_to_complete: Optional[str
     """
     if game_to_complete is not None:
         await game_service.mark_game_completed(game_to_complete)
-    completed_games, current_games = await get_games_for_index()
-    potential_winners = await get_potential_winners_list()
-    return templates.TemplateResponse('partials/both_tables.html', {'request': request,
-                                                                    "current_games": current_games,
-                                                                    "completed_games": completed_games,
-                                                                    "potential_winners": potential_winners})
+    return await render_cached_template('partials/both_tables.html', get_both_tables_context)
 
 
 @router.get('/current_games_table')
@@ -89,12 +111,7 @@ async def get_current_games_table(request: Request):
 
     This allows us to use HTMX to render changes only to the current games.
     """
-    completed_games, current_games = await get_games_for_index()
-    potential_winners = await get_potential_winners_list()
-    return templates.TemplateResponse('partials/current_games_table.html', {'request': request,
-                                                                            "current_games": current_games,
-                                                                            "completed_games": completed_games,
-                                                                            "potential_winners": potential_winners})
+    return await render_cached_template('partials/current_games_table.html', get_current_table_context)
 
 
 @router.put('/completed_games_table')
@@ -107,9 +124,4 @@ async def get_completed_games_table(request: Request, game: Optional[str]):
     if form_data:
         winner = form_data['Winner']
         await game_service.add_winner_to_game(game, winner)
-    completed_games, current_games = await get_games_for_index()
-    potential_winners = await get_potential_winners_list()
-    return templates.TemplateResponse('partials/completed_games_table.html', {'request': request,
-                                                                              "current_games": current_games,
-                                                                              "completed_games": completed_games,
-                                                                              "potential_winners": potential_winners})
+    return await render_cached_template('partials/completed_games_table.html', get_completed_table_context)
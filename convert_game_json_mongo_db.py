@@ -5,16 +5,6 @@ from civ_vi_webhook.models.db import mongo_setup
 from civ_vi_webhook.services.db import game_service, user_service
 
 
-async def connect_db():
-    with open("creds.conf", "r") as creds:
-        credentials = json.load(creds)
-    # replace civ_vi_webhook with the name of the database you want, or leave it if you're OK with this name
-    await mongo_setup.init_db('civ_vi_webhook',
-                              username=credentials.get("username"),
-                              password=credentials.get("password"),
-                              dev_server=credentials.get("development_server"))
-
-
 async def create_games():
     with open("most_recent_games.json", "r") as games_file:
         games_to_import = json.load(games_file)
@@ -37,7 +27,7 @@ async def create_games():
 
 async def main():
     print("Note: You should have run the player conversion first.")
-    await connect_db()
+    await mongo_setup.init_db_from_credentials()
     await create_games()
 
 
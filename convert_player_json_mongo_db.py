@@ -5,16 +5,6 @@ from civ_vi_webhook.models.db import mongo_setup
 from civ_vi_webhook.services.db.user_service import create_user
 
 
-async def connect_db():
-    with open("creds.conf", "r") as creds:
-        credentials = json.load(creds)
-    # replace civ_vi_webhook with the name of the database you want, or leave it if you're OK with this name
-    await mongo_setup.init_db('civ_vi_webhook',
-                              username=credentials.get("username"),
-                              password=credentials.get("password"),
-                              dev_server=credentials.get("development_server"))
-
-
 async def create_players():
     with open("player_names.conf", "r") as players:
         player_identities = json.load(players)
@@ -26,7 +16,7 @@ async def create_players():
 
 
 async def main():
-    await connect_db()
+    await mongo_setup.init_db_from_credentials()
     await create_players()
 
 
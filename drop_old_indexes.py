@@ -0,0 +1,30 @@
+import asyncio
+
+from civ_vi_webhook.models.db import mongo_setup
+
+# indexes earlier versions declared on the games collection, which no query uses any more
+OLD_GAME_INDEXES = [
+    "game_name_1",  # not unique, and game_name_unique can't be built on the same key while it's there
+    "last_turn_date_descend",  # on the old time_stamp sub-document
+]
+
+
+async def drop_old_indexes(database):
+    """Drop the indexes the games collection used to have, once, before starting the new server.
+
+    Only the indexes named in OLD_GAME_INDEXES are dropped, so any added by hand stay.
+    """
+    existing = await database["games"].index_information()
+    for index_name in OLD_GAME_INDEXES:
+        if index_name in existing:
+            await database["games"].drop_index(index_name)
+            print(f"Dropped {index_name}")
+
+
+async def main():
+    # this doesn't go through init_db, since game_name_unique can't be built while game_name_1 is still there
+    await drop_old_indexes(mongo_setup.get_database_from_credentials())
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,17 @@
+import asyncio
+
+from civ_vi_webhook.models.db import mongo_setup
+from civ_vi_webhook.services.db import game_service
+
+
+async def migrate_status():
+    await game_service.migrate_game_status_lists()
+
+
+async def main():
+    await mongo_setup.init_db_from_credentials()
+    await migrate_status()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
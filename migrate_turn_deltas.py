@@ -0,0 +1,17 @@
+import asyncio
+
+from civ_vi_webhook.models.db import mongo_setup
+from civ_vi_webhook.services.db import game_service
+
+
+async def migrate_turn_deltas():
+    await game_service.migrate_turn_deltas_to_events()
+
+
+async def main():
+    await mongo_setup.init_db_from_credentials()
+    await migrate_turn_deltas()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,30 @@
+import asyncio
+
+from civ_vi_webhook.models.db import mongo_setup
+
+
+async def remove_duplicate_games(database):
+    """Remove games that were created twice, before game names were unique.
+
+    Run this if the server fails to create the game_name_unique index. The copy with the latest turn is kept.
+    The server recounts the games when it starts.
+    """
+    duplicates = database["games"].aggregate([
+        {"$sort": {"game_info.time_stamp_v2": -1}},
+        {"$group": {"_id": "$game_name", "ids": {"$push": "$_id"}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}},
+    ])
+    async for duplicate in duplicates:
+        extra_ids = duplicate["ids"][1:]
+        await database["games"].delete_many({"_id": {"$in": extra_ids}})
+        await database["turn_events"].delete_many({"game_id": {"$in": extra_ids}})
+        print(f"Removed {len(extra_ids)} extra copies of {duplicate['_id']}")
+
+
+async def main():
+    # this doesn't go through init_db, since that would try to create the unique index first
+    await remove_duplicate_games(mongo_setup.get_database_from_credentials())
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,52 @@
+import asyncio
+from unittest.mock import patch
+
+import httpx
+
+from civ_vi_webhook.main import app
+from civ_vi_webhook.models.db import mongo_setup
+from civ_vi_webhook.services.db import (game_service, turn_event_service,
+                                        user_service)
+
+
+async def fire_parallel_webhooks(number_of_turns: int):
+    await mongo_setup.init_db("civ_vi_webhook", "", "", False, backend="memory")
+    await game_service.recount_games()
+    for player in ("Eric", "Dan"):
+        await user_service.create_user(player, index_name=player)
+    async with httpx.AsyncClient(app=app, base_url="http://test") as client:
+        responses = await asyncio.gather(*(
+            client.post("/webhook", json={"value1": "Parallel Game", "value2": ("Eric", "Dan")[turn % 2],
+                                          "value3": turn})
+            for turn in range(1, number_of_turns + 1)))
+    return responses
+
+
+add_turn_event = turn_event_service.add_turn_event
+
+
+async def slow_add_turn_event(game_id, turn_event):
+    """Earlier turns take longer to save, so unordered writes would land out of order."""
+    await asyncio.sleep((21 - turn_event.turn_number) / 200)
+    await add_turn_event(game_id, turn_event)
+
+
+@patch.object(turn_event_service, "add_turn_event", slow_add_turn_event)
+def test_parallel_webhooks_for_one_game():
+    responses = asyncio.run(fire_parallel_webhooks(20))
+    assert all(response.status_code == 201 for response in responses)
+
+    async def final_state():
+        games = await mongo_setup.Game.find(mongo_setup.Game.game_name == "Parallel Game").to_list()
+        return games, await game_service.get_turn_history("Parallel Game"), await game_service.get_game_counts()
+    games, turn_history, game_counts = asyncio.run(final_state())
+
+    assert len(games) == 1
+    game_info = games[0].game_info
+    assert game_info.turn_statistics.count == 19  # the first turn has no time since the last turn
+    assert len(turn_history) == 20
+    # the game ends up on whichever turn was applied last, and the history is in the order they were applied
+    assert game_info.turn_number == turn_history[-1].turn_number
+    assert [event.time_stamp for event in turn_history] == sorted(event.time_stamp for event in turn_history)
+    assert len(game_info.all_players) == 2
+    assert game_counts == {"total_games": 1, "current_games": 1, "completed_games": 0}
@@ -0,0 +1,87 @@
+import asyncio
+import json
+from datetime import datetime
+from unittest.mock import patch
+
+import pytest
+from beanie import PydanticObjectId
+
+from civ_vi_webhook import dependencies
+from civ_vi_webhook.models.db import mongo_setup
+from civ_vi_webhook.models.db.games import Game, GameInfo
+from civ_vi_webhook.services.db import game_service, user_service
+
+
+async def unexpected_lookup(_user_id):
+    raise AssertionError("player names should be looked up in one batch")
+
+
+async def save_games(names_and_times: list) -> PydanticObjectId:
+    """Save a game for each (name, time_stamp_v2), all waiting on one player, and return the player's id."""
+    await mongo_setup.init_db("civ_vi_webhook", "", "", False, backend="memory")
+    user_service.user_directory.invalidate()
+    eric = await user_service.create_user("Eric", index_name="Eric")
+    for name, time_stamp in names_and_times:
+        await Game(game_name=name, game_info=GameInfo(next_player_id=eric.id, turn_number=1, time_stamp_v2=time_stamp,
+                                                      all_players={eric.id})).save()
+    return eric.id
+
+
+@patch.object(user_service, "get_index_name_by_user_id", unexpected_lookup)
+def test_game_list_looks_up_player_names_once():
+    async def convert():
+        await mongo_setup.init_db("civ_vi_webhook", "", "", False, backend="memory")
+        user_service.user_directory.invalidate()
+        eric = await user_service.create_user("Eric", index_name="Eric")
+        these_games = [Game(game_name=name, game_info=GameInfo(next_player_id=player_id, turn_number=1,
+                                                               time_stamp_v2=datetime(2022, 8, 26),
+                                                               all_players={player_id}))
+                       for name, player_id in (("Known", eric.id), ("Unknown", PydanticObjectId()))]
+        return await dependencies.db_model_to_game_model_multiple(these_games)
+    converted = asyncio.run(convert())
+    player_names = [(game.game_name, game.game_info.player_name) for game in converted]
+    assert player_names == [("Known", "Eric"), ("Unknown", None)]
+
+
+def test_page_cursor_round_trip():
+    game = Game(id=PydanticObjectId(), game_name="Game",
+                game_info=GameInfo(next_player_id=PydanticObjectId(), turn_number=1,
+                                   time_stamp_v2=datetime(2022, 8, 26, 16, 24, 40), all_players=set()))
+    assert dependencies.decode_page_cursor(dependencies.encode_page_cursor(game)) == (game.game_info.time_stamp_v2,
+                                                                                      game.id)
+    game.game_info.time_stamp_v2 = None
+    assert dependencies.decode_page_cursor(dependencies.encode_page_cursor(game)) == (None, game.id)
+
+
+@pytest.mark.parametrize("cursor", ["not a cursor", "bm90IGpzb24=", "eyJ0aW1lX3N0YW1wIjogbnVsbH0="])
+def test_invalid_page_cursor(cursor):
+    with pytest.raises(ValueError):
+        dependencies.decode_page_cursor(cursor)
+
+
+def test_pages_carry_on_after_the_cursor_without_skipping_or_repeating_games():
+    async def page_through():
+        # three games share a time stamp, so the id has to break the tie between pages
+        await save_games([(f"Game {number}", datetime(2022, 8, 26 + number // 3)) for number in range(7)])
+        pages, after = [], None
+        while True:
+            page = await game_service.get_all_games(limit=2, after=after)
+            pages.append([game.game_name for game in page])
+            if len(page) < 2:
+                return pages
+            after = dependencies.decode_page_cursor(dependencies.encode_page_cursor(page[-1]))
+    pages = asyncio.run(page_through())
+    assert [name for page in pages for name in page] == [f"Game {number}" for number in range(7)]
+    assert all(len(page) == 2 for page in pages[:-1])
+
+
+@patch.object(user_service, "get_index_name_by_user_id", unexpected_lookup)
+def test_streamed_games_look_up_player_names_a_chunk_at_a_time():
+    async def stream():
+        await save_games([(f"Game {number}", datetime(2022, 8, 26, number)) for number in range(5)])
+        return [chunk async for chunk in dependencies.stream_games_as_ndjson(game_service.iterate_games(),
+                                                                             chunk_size=2)]
+    chunks = asyncio.run(stream())
+    lines = "".join(chunks).splitlines()
+    assert len(chunks) == 3
+    assert [json.loads(line)["game_info"]["player_name"] for line in lines] == ["Eric"] * 5
@@ -0,0 +1,136 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+from civ_vi_webhook.models.db import mongo_setup
+from civ_vi_webhook.models.db.games import Game, GameInfo, TurnStatistics
+from civ_vi_webhook.services.db import (game_service, turn_event_service,
+                                        user_service)
+
+START = datetime(2022, 8, 26, 16, 24, 40)
+TURN_DELTAS = [3600, 60, 86400 * 2, 5, 7200]
+
+
+async def record_turns(game_name: str, turn_times: list[datetime]):
+    await mongo_setup.init_db("civ_vi_webhook", "", "", False, backend="memory")
+    await game_service.recount_games()
+    player = await user_service.create_user("Eric", index_name="Eric")
+    for turn_number, turn_time in enumerate(turn_times, start=1):
+        await game_service.record_turn(game_name, player.id, turn_number, turn_time)
+    return await game_service.get_game(game_name)
+
+
+def turn_times_for(turn_deltas: list) -> list[datetime]:
+    turn_times = [START]
+    for turn_delta in turn_deltas:
+        turn_times.append(turn_times[-1] + timedelta(seconds=turn_delta))
+    return turn_times
+
+
+def assert_same_statistics(actual: TurnStatistics, expected: TurnStatistics):
+    assert actual.count == expected.count
+    assert actual.minimum == expected.minimum
+    assert actual.maximum == expected.maximum
+    for field in ("total", "mean", "m2"):
+        assert getattr(actual, field) == pytest.approx(getattr(expected, field))
+
+
+def test_record_turn_keeps_the_same_statistics_as_turn_statistics_add():
+    game = asyncio.run(record_turns("Statistics Game", turn_times_for(TURN_DELTAS)))
+    assert game.game_info.turn_number == len(TURN_DELTAS) + 1
+    assert game.game_info.time_stamp_v2 == START + timedelta(seconds=sum(TURN_DELTAS))
+    assert_same_statistics(game.game_info.turn_statistics, TurnStatistics.from_turn_deltas(TURN_DELTAS))
+
+
+def test_first_turn_is_not_counted():
+    game = asyncio.run(record_turns("New Game", [START]))
+    assert not game.game_info.turn_statistics
+
+
+def test_game_that_was_not_backfilled_starts_from_its_turn_deltas():
+    async def record_turn_on_old_game():
+        await mongo_setup.init_db("civ_vi_webhook", "", "", False, backend="memory")
+        player = await user_service.create_user("Eric", index_name="Eric")
+        await Game(game_name="Old Game", game_info=GameInfo(next_player_id=player.id, turn_number=5,
+                                                            time_stamp_v2=START, all_players={player.id},
+                                                            turn_deltas=TURN_DELTAS)).save()
+        await game_service.record_turn("Old Game", player.id, 6, START + timedelta(seconds=600))
+        return await game_service.get_game("Old Game")
+    game = asyncio.run(record_turn_on_old_game())
+    assert_same_statistics(game.game_info.turn_statistics, TurnStatistics.from_turn_deltas(TURN_DELTAS + [600]))
+
+
+def test_backfill_keeps_the_preformatted_average_only_when_there_are_no_turn_deltas():
+    async def backfill():
+        await mongo_setup.init_db("civ_vi_webhook", "", "", False, backend="memory")
+        player = await user_service.create_user("Eric", index_name="Eric")
+        for game_name, turn_deltas in (("Deltas Game", TURN_DELTAS), ("Imported Game", [])):
+            await Game(game_name=game_name, game_info=GameInfo(next_player_id=player.id, turn_number=5,
+                                                               time_stamp_v2=START, all_players={player.id},
+                                                               turn_deltas=turn_deltas,
+                                                               average_turn_time="0 days, 1 hours, 0 min, 0s.")).save()
+        await game_service.backfill_turn_statistics()
+        return await game_service.get_game("Deltas Game"), await game_service.get_game("Imported Game")
+    deltas_game, imported_game = asyncio.run(backfill())
+    assert_same_statistics(deltas_game.game_info.turn_statistics, TurnStatistics.from_turn_deltas(TURN_DELTAS))
+    assert deltas_game.game_info.average_turn_time is None
+    assert imported_game.game_info.average_turn_time == "0 days, 1 hours, 0 min, 0s."
+
+
+def test_record_turn_creates_the_game_then_updates_it_in_place():
+    async def record_two_turns():
+        await mongo_setup.init_db("civ_vi_webhook", "", "", False, backend="memory")
+        await game_service.recount_games()
+        eric = await user_service.create_user("Eric", index_name="Eric")
+        dan = await user_service.create_user("Dan", index_name="Dan")
+        created = await game_service.record_turn("Upsert Game", eric.id, 1, START)
+        previous = await game_service.record_turn("Upsert Game", dan.id, 2, START + timedelta(hours=1))
+        return eric, dan, created, previous, await Game.find_all().to_list(), await game_service.get_game_counts()
+    eric, dan, created, previous, games, game_counts = asyncio.run(record_two_turns())
+
+    assert created is None
+    assert (previous.game_info.turn_number, previous.game_info.next_player_id) == (1, eric.id)
+    assert len(games) == 1
+    assert (games[0].game_info.turn_number, games[0].game_info.next_player_id) == (2, dan.id)
+    assert games[0].game_info.all_players == {eric.id, dan.id}
+    assert game_counts == {"total_games": 1, "current_games": 1, "completed_games": 0}
+
+
+def test_migrating_turn_deltas_twice_keeps_one_copy_of_each_turn():
+    async def migrate_twice():
+        await mongo_setup.init_db("civ_vi_webhook", "", "", False, backend="memory")
+        player = await user_service.create_user("Eric", index_name="Eric")
+        game = Game(game_name="Migrated Game", game_info=GameInfo(next_player_id=player.id, turn_number=5,
+                                                                  time_stamp_v2=START, all_players={player.id},
+                                                                  turn_deltas=TURN_DELTAS))
+        await game.save()
+        await game_service.migrate_turn_deltas_to_events()
+        # as if the first run stopped before it removed the game's turn_deltas
+        await Game.get_motor_collection().update_one({"_id": game.id},
+                                                     {"$set": {"game_info.turn_deltas": TURN_DELTAS}})
+        await game_service.migrate_turn_deltas_to_events()
+        return await turn_event_service.get_turn_history(game.id)
+    history = asyncio.run(migrate_twice())
+    assert [event.turn_delta for event in history] == TURN_DELTAS
+
+
+def test_turn_that_arrives_late_does_not_replace_a_newer_turn():
+    async def record_out_of_order():
+        await mongo_setup.init_db("civ_vi_webhook", "", "", False, backend="memory")
+        await game_service.recount_games()
+        eric = await user_service.create_user("Eric", index_name="Eric")
+        dan = await user_service.create_user("Dan", index_name="Dan")
+        await game_service.record_turn("Late Game", eric.id, 1, START)
+        await game_service.record_turn("Late Game", eric.id, 3, START + timedelta(seconds=20))
+        stale = await game_service.record_turn("Late Game", dan.id, 2, START + timedelta(seconds=10))
+        game = await game_service.get_game("Late Game")
+        return stale, game, eric.id, await game_service.get_turn_history("Late Game")
+    stale, game, eric_id, history = asyncio.run(record_out_of_order())
+    assert stale is None
+    assert game.game_info.turn_number == 3
+    assert game.game_info.next_player_id == eric_id
+    assert game.game_info.time_stamp_v2 == START + timedelta(seconds=20)
+    assert game.game_info.turn_statistics.minimum >= 0
+    assert_same_statistics(game.game_info.turn_statistics, TurnStatistics.from_turn_deltas([20]))
+    assert [event.turn_number for event in history] == [1, 3]
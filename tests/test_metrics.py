@@ -0,0 +1,26 @@
+import asyncio
+
+import pytest
+
+from civ_vi_webhook.services import metrics
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = metrics.Histogram("test_seconds", "A test.", ("route",), buckets=(0.1, 1.0))
+    for seconds in (0.05, 0.1, 0.5, 3):
+        histogram.observe(seconds, '/say "hi"')
+    assert histogram.samples() == ['test_seconds_bucket{route="/say \\"hi\\"",le="0.1"} 2',
+                                   'test_seconds_bucket{route="/say \\"hi\\"",le="1.0"} 3',
+                                   'test_seconds_bucket{route="/say \\"hi\\"",le="+Inf"} 4',
+                                   'test_seconds_sum{route="/say \\"hi\\""} 3.65',
+                                   'test_seconds_count{route="/say \\"hi\\""} 4']
+
+
+def test_timed_service_call_records_failures_too():
+    @metrics.timed_service_call
+    async def fails():
+        raise ValueError
+
+    with pytest.raises(ValueError):
+        asyncio.run(fails())
+    assert metrics.service_call_seconds.count(f"test_metrics.{fails.__qualname__}") == 1
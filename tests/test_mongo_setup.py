@@ -0,0 +1,29 @@
+import asyncio
+
+import pytest
+
+from civ_vi_webhook.models.db import mongo_setup
+from civ_vi_webhook.services.db import matrix_service
+
+
+def test_memory_backend_keeps_data_for_the_process():
+    async def save_and_read():
+        await mongo_setup.init_db("civ_vi_webhook", "", "", True, backend="memory")
+        await matrix_service.write_next_batch("s72595_4483_1934")
+        return await matrix_service.get_next_batch()
+    assert asyncio.run(save_and_read()) == "s72595_4483_1934"
+
+
+def test_unknown_backend():
+    with pytest.raises(ValueError, match="sqlite"):
+        mongo_setup.get_database("civ_vi_webhook", "", "", False, backend="sqlite")
+
+
+def test_connection_settings_from_creds_conf(tmp_path):
+    creds = tmp_path / "creds.conf"
+    creds.write_text('{"username": "eric", "password": "secret", "development_server": true, '
+                     '"database_backend": "mongodb", "mongo_url": "mongodb://db:27017"}')
+    assert mongo_setup.connection_settings(mongo_setup.read_credentials(str(creds))) == {
+        "username": "eric", "password": "secret", "dev_server": True, "backend": "mongodb",
+        "mongo_url": "mongodb://db:27017"}
+    assert mongo_setup.connection_settings({})["backend"] == "atlas"
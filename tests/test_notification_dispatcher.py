@@ -0,0 +1,111 @@
+import asyncio
+from datetime import datetime, timedelta
+
+from civ_vi_webhook.models.db import mongo_setup
+from civ_vi_webhook.models.db.notifications import Notification
+from civ_vi_webhook.services import metrics
+from civ_vi_webhook.services.db import notification_service
+from civ_vi_webhook.services.matrix.notification_dispatcher import (
+    NotificationDispatcher, build_digest)
+
+
+class FlakyMatrixBot:
+    """Fails the first `failures` sends, then delivers."""
+
+    def __init__(self, failures: int):
+        self.failures = failures
+        self.sent = []
+
+    async def send_message(self, message: str):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError("homeserver unreachable")
+        self.sent.append(message)
+
+
+def notification(message: str, game_name: str = None, turn_number: int = None) -> Notification:
+    # construct, since a beanie Document can't be made before init_db
+    return Notification.construct(message=message, recipient="Eric", game_name=game_name, turn_number=turn_number)
+
+
+def test_digest_lists_each_game_once():
+    digest = build_digest([notification("Hey, Eric, it's your turn in Game A", "Game A", 5),
+                           notification("Eric's turn in Game A (from PYDT)", "Game A", 5),
+                           notification("Hey, Eric, it's your turn in Game B", "Game B", 12)])
+    assert digest == "Hey, Eric, it's your turn in 2 games: Game A (turn 5), Game B (turn 12)"
+
+
+def test_digest_keeps_the_message_of_notifications_without_a_game():
+    digest = build_digest([notification("Hey, Eric, it's your turn in Game A", "Game A", 5),
+                           notification("The server restarted"),
+                           notification("Game B was completed"),
+                           notification("The server restarted")])
+    assert digest == "Hey, Eric, it's your turn in Game A\nThe server restarted\nGame B was completed"
+
+
+def test_retry_delay_doubles_up_to_the_maximum():
+    dispatcher = NotificationDispatcher(FlakyMatrixBot(0), base_retry_delay=2, max_retry_delay=10)
+    assert [dispatcher.retry_delay(attempts).total_seconds() for attempts in range(1, 6)] == [2, 4, 8, 10, 10]
+
+
+def test_failed_send_is_retried_after_the_backoff():
+    async def deliver():
+        await mongo_setup.init_db("civ_vi_webhook", "", "", False, backend="memory")
+        bot = FlakyMatrixBot(failures=1)
+        dispatcher = NotificationDispatcher(bot, base_retry_delay=60, min_send_interval=0)
+        await notification_service.enqueue_notification("Hey, Eric, it's your turn")
+        await dispatcher.deliver_due_notifications()
+        after_failure = await Notification.find_one()
+        await dispatcher.deliver_due_notifications()  # not due again until the backoff has passed
+        sent_during_backoff = list(bot.sent)
+        await Notification.get_motor_collection().update_many({}, {"$set": {"next_attempt_at": datetime.now()}})
+        await dispatcher.deliver_due_notifications()
+        return bot, sent_during_backoff, after_failure, await Notification.find_one()
+    bot, sent_during_backoff, after_failure, delivered = asyncio.run(deliver())
+
+    assert after_failure.status == "pending"
+    assert after_failure.attempts == 1
+    assert "homeserver unreachable" in after_failure.last_error
+    assert after_failure.next_attempt_at > datetime.now() + timedelta(seconds=50)
+    assert sent_during_backoff == []
+    assert bot.sent == ["Hey, Eric, it's your turn"]
+    assert delivered.status == "delivered"
+    assert delivered.attempts == 2
+
+
+def test_notification_is_given_up_on_after_max_attempts():
+    async def deliver():
+        await mongo_setup.init_db("civ_vi_webhook", "", "", False, backend="memory")
+        dispatcher = NotificationDispatcher(FlakyMatrixBot(failures=5), max_attempts=1, min_send_interval=0)
+        await notification_service.enqueue_notification("Hey, Eric, it's your turn")
+        await dispatcher.deliver_due_notifications()
+        return await Notification.find_one()
+    assert asyncio.run(deliver()).status == "failed"
+
+
+def test_digest_is_given_up_on_when_any_of_its_notifications_is_out_of_attempts():
+    async def deliver():
+        await mongo_setup.init_db("civ_vi_webhook", "", "", False, backend="memory")
+        dispatcher = NotificationDispatcher(FlakyMatrixBot(failures=5), max_attempts=3, min_send_interval=0)
+        await notification_service.enqueue_notification("Hey, Eric, it's your turn in Game A", "Eric", "Game A", 5)
+        retried = await notification_service.enqueue_notification("Hey, Eric, it's your turn in Game B", "Eric",
+                                                                  "Game B", 12, hold_for=timedelta(hours=1))
+        await Notification.get_motor_collection().update_one({"_id": retried.id}, {"$set": {"attempts": 2}})
+        await dispatcher.deliver_due_notifications()
+        return [notification.status for notification in await Notification.find().to_list()]
+    assert asyncio.run(deliver()) == ["failed", "failed"]
+
+
+def test_failed_digest_counts_an_attempt_for_each_notification():
+    async def deliver():
+        await mongo_setup.init_db("civ_vi_webhook", "", "", False, backend="memory")
+        dispatcher = NotificationDispatcher(FlakyMatrixBot(failures=1), min_send_interval=0)
+        for game_name in ("Game A", "Game B"):
+            message = f"Hey, Eric, it's your turn in {game_name}"
+            await notification_service.enqueue_notification(message, "Eric", game_name, 5)
+        await dispatcher.deliver_due_notifications()
+        return dispatcher
+    failed_before = metrics.notifications.value("failed_attempt")
+    dispatcher = asyncio.run(deliver())
+    assert dispatcher.failed_attempt_count == 2
+    assert metrics.notifications.value("failed_attempt") - failed_before == 2
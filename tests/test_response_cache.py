@@ -0,0 +1,79 @@
+import asyncio
+from typing import Optional
+
+from pydantic import BaseModel
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+
+from civ_vi_webhook import dependencies
+from civ_vi_webhook.services.response_cache import (VersionedCache,
+                                                    bump_data_version,
+                                                    response_cache)
+
+
+class Counts(BaseModel):
+    games: int
+
+
+def make_request(if_none_match: Optional[str] = None) -> Request:
+    headers = [(b"if-none-match", if_none_match.encode())] if if_none_match else []
+    return Request({"type": "http", "method": "GET", "path": "/total_number_of_games", "query_string": b"",
+                    "headers": headers})
+
+
+class CountingBuilder:
+    def __init__(self, result=None):
+        self.calls = 0
+        self.result = result or {"games": 3}
+
+    async def __call__(self):
+        self.calls += 1
+        return self.result
+
+
+def test_matching_etag_gets_a_304_without_building_the_response():
+    bump_data_version()  # start without anything cached by other tests
+    build = CountingBuilder()
+    first = asyncio.run(dependencies.cached_response(make_request(), Counts, build))
+    second = asyncio.run(dependencies.cached_response(make_request(first.headers["ETag"]), Counts, build))
+    assert first.status_code == 200 and first.body == b'{"games": 3}'
+    assert second.status_code == 304
+    assert second.headers["ETag"] == first.headers["ETag"]
+    assert build.calls == 1
+
+
+def test_cached_body_is_reused_until_the_data_changes():
+    bump_data_version()
+    build = CountingBuilder()
+    first = asyncio.run(dependencies.cached_response(make_request(), Counts, build))
+    asyncio.run(dependencies.cached_response(make_request(), Counts, build))
+    assert build.calls == 1
+    bump_data_version()
+    after_bump = asyncio.run(dependencies.cached_response(make_request(first.headers["ETag"]), Counts, build))
+    assert after_bump.status_code == 200
+    assert after_bump.headers["ETag"] != first.headers["ETag"]
+    assert build.calls == 2
+
+
+def test_responses_from_the_builder_are_passed_through_and_not_cached():
+    bump_data_version()
+    build = CountingBuilder(JSONResponse(status_code=404, content={"error": "Not found"}))
+    for _ in range(2):
+        assert asyncio.run(dependencies.cached_response(make_request(), Counts, build)).status_code == 404
+    assert build.calls == 2
+    assert response_cache.get("/total_number_of_games?[]") is None
+
+
+def test_value_built_before_a_bump_is_not_stored():
+    cache = VersionedCache()
+    version = cache.version
+    cache.bump()
+    cache.put("key", b"stale", version)
+    assert cache.get("key") is None
+
+
+def test_weak_and_listed_etags_match():
+    etag = response_cache.etag("key")
+    assert dependencies.etag_matches(make_request(f'"other", W/{etag}'), etag)
+    assert dependencies.etag_matches(make_request("*"), etag)
+    assert not dependencies.etag_matches(make_request('"other"'), etag)
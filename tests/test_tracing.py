@@ -0,0 +1,71 @@
+import asyncio
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import httpx
+import pytest
+
+from civ_vi_webhook.main import app
+from civ_vi_webhook.models.db import mongo_setup
+from civ_vi_webhook.services import tracing
+
+
+async def get(path: str, headers: dict) -> httpx.Response:
+    await mongo_setup.init_db("civ_vi_webhook", "", "", False, backend="memory")
+    async with httpx.AsyncClient(app=app, base_url="http://test") as client:
+        return await client.get(path, headers=headers)
+
+
+async def get_current_games(headers: dict) -> httpx.Response:
+    return await get("/current_games", headers)
+
+
+@patch.object(tracing, "allow_trace_header", True)
+def test_traced_request_gets_a_breakdown():
+    response = asyncio.run(get_current_games({"X-Trace": "1"}))
+    assert response.headers["Server-Timing"].startswith("total;dur=")
+    assert 'game_service.get_current_games;dur=' in response.headers["Server-Timing"]
+    trace = tracing.recent_traces.get(response.headers["X-Trace-Id"])
+    assert trace.path == "/current_games"
+
+
+def test_untraced_request_has_no_breakdown():
+    response = asyncio.run(get_current_games({}))
+    assert "Server-Timing" not in response.headers
+
+
+def test_mongo_round_trips_are_spans_of_the_current_trace():
+    trace = tracing.Trace("GET", "/current_games")
+    token = tracing.current_trace.set(trace)
+    try:
+        tracing.MongoCommandSpans().succeeded(SimpleNamespace(command_name="find", duration_micros=1500))
+    finally:
+        tracing.current_trace.reset(token)
+    tracing.MongoCommandSpans().succeeded(SimpleNamespace(command_name="find", duration_micros=1500))
+    assert [(name, duration) for name, _start, duration in trace.spans] == [("mongo.find", 0.0015)]
+
+
+def test_trace_header_is_ignored_unless_allowed():
+    assert "Server-Timing" not in asyncio.run(get_current_games({"X-Trace": "profile"})).headers
+    assert asyncio.run(get("/traces", {})).status_code == 404
+
+
+@patch.object(tracing, "sample_rate", 1.0)
+def test_sampled_request_is_not_profiled_unless_the_header_is_allowed():
+    response = asyncio.run(get_current_games({"X-Trace": "profile"}))
+    assert tracing.recent_traces.get(response.headers["X-Trace-Id"]).profile is None
+
+
+@pytest.mark.parametrize("trace_sample_rate", [-0.1, 1.5, "0.1", True, None])
+def test_trace_sample_rate_must_be_a_number_from_0_to_1(trace_sample_rate):
+    with pytest.raises(ValueError, match="trace_sample_rate"):
+        tracing.configure(trace_sample_rate)
+
+
+def test_configure():
+    try:
+        tracing.configure(0.25, allow_header=True)
+        assert (tracing.sample_rate, tracing.allow_trace_header) == (0.25, True)
+    finally:
+        tracing.configure()
+    assert (tracing.sample_rate, tracing.allow_trace_header) == (0.0, False)
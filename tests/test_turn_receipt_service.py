@@ -0,0 +1,78 @@
+import asyncio
+from datetime import datetime, timedelta
+from unittest.mock import patch
+
+from civ_vi_webhook.models.db import mongo_setup
+from civ_vi_webhook.services.db import turn_receipt_service
+from civ_vi_webhook.services.db.turn_receipt_service import RecentTurns
+
+RECEIVED_AT = datetime.utcnow()  # older receipts would be expired by the TTL index straight away
+TURN = ("Game", "Eric", 12, "pbc")
+
+
+async def claim_turn(received_at: datetime = RECEIVED_AT) -> bool:
+    return await turn_receipt_service.claim_turn(*TURN, received_at)
+
+
+def run_with_fresh_receipts(claims):
+    async def run():
+        await mongo_setup.init_db("civ_vi_webhook", "", "", False, backend="memory")
+        turn_receipt_service.recent_turns = RecentTurns()
+        return await claims()
+    return asyncio.run(run())
+
+
+def test_second_copy_of_a_turn_is_a_duplicate():
+    async def claims():
+        return [await claim_turn(), await claim_turn(RECEIVED_AT + timedelta(seconds=5))]
+    assert run_with_fresh_receipts(claims) == [True, False]
+
+
+def test_duplicate_is_caught_by_the_database_when_this_process_hasnt_seen_the_turn():
+    async def claims():
+        first = await claim_turn()
+        turn_receipt_service.recent_turns = RecentTurns()  # as if another server process got the copy
+        return [first, await claim_turn(RECEIVED_AT + timedelta(seconds=5))]
+    assert run_with_fresh_receipts(claims) == [True, False]
+
+
+def test_released_turn_can_be_claimed_again():
+    async def claims():
+        first = await claim_turn()
+        await turn_receipt_service.release_turn(*TURN)
+        return [first, await claim_turn(RECEIVED_AT + timedelta(seconds=5))]
+    assert run_with_fresh_receipts(claims) == [True, True]
+
+
+def test_receipt_older_than_the_window_is_taken_over():
+    async def claims():
+        first = await claim_turn()
+        turn_receipt_service.recent_turns = RecentTurns()
+        later = RECEIVED_AT + timedelta(seconds=turn_receipt_service.DUPLICATE_WINDOW_SECONDS + 1)
+        return [first, await claim_turn(later)]
+    assert run_with_fresh_receipts(claims) == [True, True]
+
+
+def test_memory_backend_removes_receipts_older_than_the_window():
+    async def claims():
+        await claim_turn(RECEIVED_AT - timedelta(seconds=turn_receipt_service.DUPLICATE_WINDOW_SECONDS + 1))
+        await turn_receipt_service.claim_turn("Game", "Dan", 13, "pbc", RECEIVED_AT)
+        return [receipt.player for receipt in await mongo_setup.TurnReceipt.find_all().to_list()]
+    assert run_with_fresh_receipts(claims) == ["Dan"]
+
+
+def test_recent_turns_expire_after_the_ttl():
+    recent = RecentTurns(ttl_seconds=60)
+    with patch.object(turn_receipt_service.time, "monotonic", return_value=1000):
+        recent.add(TURN)
+        assert TURN in recent
+    with patch.object(turn_receipt_service.time, "monotonic", return_value=1060):
+        assert TURN not in recent
+
+
+def test_recent_turns_drop_the_oldest_when_full():
+    recent = RecentTurns(max_entries=2)
+    for turn_number in range(3):
+        recent.add(("Game", "Eric", turn_number, "pbc"))
+    assert ("Game", "Eric", 0, "pbc") not in recent
+    assert ("Game", "Eric", 2, "pbc") in recent
@@ -0,0 +1,40 @@
+import asyncio
+
+from beanie import PydanticObjectId
+
+from civ_vi_webhook.models.db import mongo_setup
+from civ_vi_webhook.models.db.user import User
+from civ_vi_webhook.services.db import user_service
+
+
+def test_users_added_by_another_process_are_found():
+    async def look_up():
+        await mongo_setup.init_db("civ_vi_webhook", "", "", False, backend="memory")
+        await user_service.warm_user_cache()
+        # saved straight to the database, as the listener or a conversion script would
+        user = User(steam_username="Dan", matrix_username="@dan:example.com", index_name="Dan")
+        await user.save()
+        return user, (await user_service.get_user_id_from_matrix_username("@dan:example.com"),
+                      await user_service.find_user("Dan"),
+                      await user_service.get_user_id_from_matrix_username("@nobody:example.com"))
+    user, (user_id, found_user, missing) = asyncio.run(look_up())
+    assert user_id == user.id
+    assert found_user.id == user.id
+    assert missing is None
+
+
+def test_unknown_user_ids_are_not_looked_up_again_until_the_directory_reloads():
+    async def look_up():
+        await mongo_setup.init_db("civ_vi_webhook", "", "", False, backend="memory")
+        await user_service.warm_user_cache()
+        user = User.construct(steam_username="Stella", index_name="Stella")
+        user.id = PydanticObjectId()
+        first = await user_service.get_index_names_by_user_ids([user.id])
+        await user.save()  # added behind the directory's back
+        cached_miss = await user_service.get_index_names_by_user_ids([user.id])
+        user_service.user_directory.invalidate()
+        return user.id, first, cached_miss, await user_service.get_index_names_by_user_ids([user.id])
+    user_id, first, cached_miss, after_reload = asyncio.run(look_up())
+    assert first == {}
+    assert cached_miss == {}
+    assert after_reload == {user_id: "Stella"}